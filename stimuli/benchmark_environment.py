@@ -0,0 +1,38 @@
+'''
+Benchmark environment
+
+ABOUT:
+The commit, library versions and host information that the benchmarks
+(benchmark_surprisal.py, benchmark_pseudorandomize.py) store with their
+results, so that runs can be compared across commits and machines.
+'''
+
+
+import importlib
+import os
+import platform
+import subprocess
+
+
+def get_environment(libraries=(), **details):
+    """
+    Commit, library versions and host information for comparing runs.
+
+    Parameters:
+    libraries (list): names of the modules whose __version__ is recorded.
+    details: further entries (e.g. torch_threads=4).
+
+    Returns:
+    environment (dict)
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit,
+            'python': platform.python_version(),
+            **{name: importlib.import_module(name).__version__ for name in libraries},
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            **details}
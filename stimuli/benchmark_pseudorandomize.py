@@ -0,0 +1,272 @@
+'''
+Pseudorandomization benchmark
+
+ABOUT:
+Measures how the pseudorandomization of pseudorandomize.py scales, on
+synthetic lists shaped like the PCIbex lists (items in conditions,
+good and bad fillers, questions with F/J answers):
+
+- sizes:     40 to 10,000 rows (SIZES)
+- balances:  share of fillers and of each condition among the items
+             (BALANCES)
+- tightness: maximal run lengths, from loose to tight (TIGHTNESS); the
+             default level has the rules of pseudorandomization_constraints.txt
+
+As in pseudorandomize_many_orders.py, every order starts with the block
+start of pseudorandomization_constraints.txt (its Position rules and its
+Constraint rules for given positions; see get_block_start).
+Every combination is run for several orders (one random seed per order).
+For every order, the statistics of the search are kept as returned by
+pseudorandomize_order (or attached to NoSolutionError if it failed; see
+solve_order): time, restarts, backtracks and, per position, the number of
+eligible rows (and of the distinct code combinations among them).
+Per combination, the benchmark reports the time and restarts per order,
+the eligible-set sizes and the failure rate.
+
+benchmark() returns the results as a list of dicts. The script writes them
+to a JSON file together with the commit and library versions, so that
+runs can be compared across commits.
+
+USAGE:
+python benchmark_pseudorandomize.py [--output FILE] [--sizes 40,100,...]
+                                    [--balances ...] [--tightness ...]
+                                    [--orders N] [--time-limit SECONDS]
+                                    [--quick]
+'''
+
+
+import argparse
+import json
+import os
+import random
+import sys
+
+import numpy as np
+import pandas as pd
+
+from benchmark_environment import get_environment
+from pseudorandomize import (read_rules, parse_rules, pseudorandomize_order,
+                             NoSolutionError)
+
+
+SIZES = [40, 100, 400, 1000, 4000, 10000]
+QUICK_SIZES = [40, 100, 400, 1000]
+
+# name: (share of fillers, relative number of items per condition); with
+# fewer fillers, or one condition for more than half of the items, no
+# order exists under the default rules
+BALANCES = {
+    "balanced": (0.5, (1, 1, 1, 1)),
+    "few-fillers": (0.35, (1, 1, 1, 1)),
+    "skewed": (0.5, (3, 2, 2, 1)),
+}
+
+# Rules file of pseudorandomize_many_orders.py, for the block start
+RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "pseudorandomization_constraints.txt")
+
+# name: rules (maximal run lengths)
+TIGHTNESS = {
+    "loose": """
+Constraint ExpCondition 2
+Constraint Type 3
+Constraint HasQuestion 4
+Constraint Answer 4
+""",
+    "default": """
+Constraint ExpCondition 1
+Constraint Type 2
+Constraint HasQuestion 3
+Constraint Answer 3
+""",
+    "tight": """
+Constraint ExpCondition 1
+Constraint Type 2
+Constraint HasQuestion 2
+Constraint Answer 2
+""",
+}
+
+
+def get_block_start(filename=RULES_FILE):
+    """
+    The rules of a rules file that only apply at the start of an order:
+    Position rules and Constraint rules for given positions.
+    """
+    return [rule for rule in read_rules(filename)
+            if rule["rule"] == "Position"
+            or (rule["rule"] == "Constraint" and rule["positions"])]
+
+
+def make_list(n_rows, filler_share=0.5, condition_weights=(1, 1, 1, 1),
+              seed=0):
+    """
+    Synthetic list of n_rows rows: items, whose conditions are drawn in
+    proportion to condition_weights, and good and bad fillers. A third of
+    the items and half of the fillers have a question, answered with F
+    or J. Cells without a condition, question or answer are empty, the
+    HasQuestion column is filled as in pseudorandomize_many_orders.py.
+    """
+    rng = np.random.default_rng(seed)
+    n_fillers = round(n_rows * filler_share)
+    n_items = n_rows - n_fillers
+    weights = np.array(condition_weights) / sum(condition_weights)
+    conditions = [chr(ord("A") + c) for c in range(len(weights))]
+    # Exact number of items per condition, then shuffled over the items
+    per_condition = np.floor(weights * n_items).astype(int)
+    per_condition[:n_items - per_condition.sum()] += 1
+    item_conditions = rng.permutation(np.repeat(conditions, per_condition))
+
+    has_question = np.concatenate([rng.random(n_items) < 1 / 3,
+                                   rng.random(n_fillers) < 1 / 2])
+    answers = rng.choice(["F", "J"], n_rows)
+    return pd.DataFrame({
+        "ItemNum": np.arange(1, n_rows + 1),
+        "Type": ["Item"] * n_items
+                + list(rng.choice(["FillerGood", "FillerBad"], n_fillers)),
+        "ExpCondition": list(item_conditions) + [None] * n_fillers,
+        "HasQuestion": np.where(has_question, "Yes", "No"),
+        "Answer": np.where(has_question, answers, None),
+    })
+
+
+def run_orders(df, rules, n_orders, time_limit):
+    """
+    Draw n_orders orders of df, each with its own random seed.
+
+    Returns the search statistics of every order (with the key "error" for
+    the orders that failed).
+    """
+    runs = []
+    for seed in range(n_orders):
+        random.seed(seed)
+        try:
+            _, stats = pseudorandomize_order(df, df.iloc[:0], rules,
+                                             time_limit=time_limit)
+            stats = dict(stats, error=None)
+        except NoSolutionError as e:
+            stats = dict(e.stats or {}, error=str(e))
+        runs.append(stats)
+    return runs
+
+
+def summarize(runs):
+    """
+    Per-combination summary of the statistics of its orders: time and
+    restarts per order (mean over all orders, failed ones included, and
+    maximum), eligible-set sizes and the failure rate.
+    """
+    succeeded = [run for run in runs if run["error"] is None]
+
+    def values(key):
+        return [run[key] for run in runs if run.get(key) is not None]
+
+    eligible = {}
+    for unit in ("rows", "keys"):
+        means = values(f"eligible_{unit}_mean")
+        minima = values(f"eligible_{unit}_min")
+        eligible[f"eligible_{unit}_mean"] = (float(np.mean(means))
+                                             if means else None)
+        eligible[f"eligible_{unit}_min"] = min(minima) if minima else None
+    return {
+        "n_orders": len(runs),
+        "failures": len(runs) - len(succeeded),
+        "failure_rate": (len(runs) - len(succeeded)) / len(runs),
+        "seconds_per_order": float(np.mean([run["seconds"] for run in runs])),
+        "max_seconds": max(run["seconds"] for run in runs),
+        "restarts_per_order": float(np.mean([run["restarts"]
+                                             for run in runs])),
+        "max_restarts": max(run["restarts"] for run in runs),
+        "backtracks_per_order": float(np.mean([run["backtracks"]
+                                               for run in runs])),
+        **eligible,
+    }
+
+
+def benchmark(sizes=SIZES, balances=None, tightness=None, n_orders=5,
+              time_limit=30):
+    """
+    Run all combinations of size, balance and tightness.
+
+    Returns a list of result dicts: the combination, the summary (see
+    summarize) and the statistics of every order ("orders").
+    """
+    if balances is None:
+        balances = list(BALANCES)
+    if tightness is None:
+        tightness = list(TIGHTNESS)
+    start_rules = get_block_start()
+
+    results = []
+    for size in sizes:
+        for balance in balances:
+            df = make_list(size, *BALANCES[balance])
+            for level in tightness:
+                rules = (parse_rules(TIGHTNESS[level].splitlines(), level)
+                         + start_rules)
+                runs = run_orders(df, rules, n_orders, time_limit)
+                result = {"n_rows": size,
+                          "balance": balance,
+                          "tightness": level,
+                          **summarize(runs),
+                          "orders": runs}
+                results.append(result)
+                print(f"{size:6} {balance:11} {level:8} "
+                      f"{result['seconds_per_order'] * 1000:10.1f} ms/order "
+                      f"{result['restarts_per_order']:7.2f} restarts "
+                      f"{result['eligible_rows_mean'] or 0:8.1f} eligible rows "
+                      f"({result['eligible_keys_mean'] or 0:.1f} keys) "
+                      f"{result['failure_rate']:5.0%} failed", flush=True)
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        usage=f"{sys.argv[0]} [--output FILE] [--sizes 40,100,...] "
+              "[--balances ...] [--tightness ...] [--orders N] "
+              "[--time-limit SECONDS] [--quick]")
+    parser.add_argument("--output", default="benchmark_pseudorandomize.json",
+                        help="JSON file for the results "
+                             "(default: benchmark_pseudorandomize.json)")
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)),
+                        help="comma-separated numbers of rows "
+                             f"(default: {','.join(map(str, SIZES))})")
+    parser.add_argument("--balances", default=",".join(BALANCES),
+                        help="comma-separated list balances "
+                             f"(default: {','.join(BALANCES)})")
+    parser.add_argument("--tightness", default=",".join(TIGHTNESS),
+                        help="comma-separated constraint levels "
+                             f"(default: {','.join(TIGHTNESS)})")
+    parser.add_argument("--orders", type=int, default=5,
+                        help="orders per combination (default: 5)")
+    parser.add_argument("--time-limit", type=float, default=30,
+                        help="search time limit per order in seconds "
+                             "(default: 30)")
+    parser.add_argument("--quick", action="store_true",
+                        help="only run the sizes "
+                             f"{', '.join(map(str, QUICK_SIZES))}")
+    args = parser.parse_args()
+
+    sizes = QUICK_SIZES if args.quick else [int(size) for size
+                                            in args.sizes.split(",")]
+    balances = [b.strip() for b in args.balances.split(",")]
+    tightness = [t.strip() for t in args.tightness.split(",")]
+    for balance in balances:
+        if balance not in BALANCES:
+            parser.error(f"Unknown balance {balance}, choose from: "
+                         f"{', '.join(BALANCES)}.")
+    for level in tightness:
+        if level not in TIGHTNESS:
+            parser.error(f"Unknown tightness {level}, choose from: "
+                         f"{', '.join(TIGHTNESS)}.")
+    if args.orders < 1:
+        parser.error("--orders must be at least 1.")
+
+    results = benchmark(sizes, balances, tightness, args.orders,
+                        args.time_limit)
+    with open(args.output, "w") as file:
+        json.dump({"environment": get_environment(["numpy", "pandas"]),
+                   "results": results},
+                  file, indent=2)
+    print(f"\nWriting to file: {args.output}")
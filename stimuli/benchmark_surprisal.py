@@ -0,0 +1,263 @@
+'''
+Offline surprisal benchmark
+
+ABOUT:
+Measures the throughput of the scoring paths of surprisal.py without
+downloading any checkpoint: small GPT-2-style and Llama-style models with
+random weights are built from scratch, together with byte-level BPE
+tokenizers trained on a synthetic corpus (GPT-2 style: pre-split words
+behind an <|endoftext|> start token; Llama style: plain text with a
+<|begin_of_text|> start token added by the tokenizer).
+
+Every model is run on sentence sets of varied length and count, shaped like
+stimulus files (items whose conditions share a context and differ in the
+last words), through these paths:
+
+- single:   one sentence per forward pass (get_surprisal_many, batch size 1)
+- batched:  padded, length-bucketed batches
+- prefix:   shared prefixes run once (share_prefix)
+- window:   sliding window over the whole text
+- file:     get_surprisal_file on a CSV (read, score, write)
+
+For every run it reports sentences/sec, tokens/sec, the per-stage latency
+(tokenization, forward pass, softmax/gather, aggregation, file I/O; see
+surprisal_profiler.py) and the peak RSS of the process so far.
+The random weights make the surprisal values meaningless, but the amount
+of computation is the same as for a trained model of the same shape.
+
+Results are written to a JSON file together with the commit and library
+versions, so that runs can be compared across commits.
+
+USAGE:
+python benchmark_surprisal.py [--output FILE] [--models gpt2,llama]
+                              [--paths single,batched,...] [--repeat N]
+                              [--quick]
+'''
+
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+import surprisal
+from benchmark_environment import get_environment
+from surprisal_profiler import profiler
+
+
+VOCABULARY = ("the a an this that house dog cat garden baker bread morning evening "
+              "children teacher letter window table key old new small big quickly slowly "
+              "ran found said went opened closed wrote read under over into near after "
+              "before because while he she they it we yesterday today 2024 don't it's").split()
+
+# name: (number of sentences, shared context words per item, ending words per condition)
+SENTENCE_SETS = {
+    'short-50': (50, 8, 2),
+    'short-400': (400, 8, 2),
+    'medium-200': (200, 25, 3),
+    'long-40': (40, 150, 5),
+}
+QUICK_SENTENCE_SETS = ['short-50', 'medium-200']
+PATHS = ['single', 'batched', 'prefix', 'window', 'file']
+CONDITIONS = 4
+
+
+def make_sentences(n_sentences, context_words, ending_words, seed=0):
+    """
+    Synthetic stimuli: items of CONDITIONS sentences that share a context of
+    context_words words and end in different ending_words words.
+    """
+    rng = random.Random(seed)
+    sentences = []
+    while len(sentences) < n_sentences:
+        context = [rng.choice(VOCABULARY) for _ in range(context_words)]
+        for _ in range(CONDITIONS):
+            ending = [rng.choice(VOCABULARY) for _ in range(ending_words)]
+            sentences.append(" ".join(context + ending) + ".")
+    return sentences[:n_sentences]
+
+
+def train_tokenizer(start_token, prefix_space, vocab_size=1000):
+    """
+    Train a byte-level BPE tokenizer on a synthetic corpus. With
+    prefix_space=True it behaves like the GPT-2 tokenizer on pre-split words
+    (add_prefix_space); otherwise it adds start_token in front of every text
+    like the Llama 3 tokenizer.
+    """
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, processors, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    corpus = make_sentences(4000, 10, 2, seed=1)
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=vocab_size, special_tokens=[start_token], show_progress=False,
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(corpus, trainer)
+
+    if prefix_space:
+        tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=True)
+        tokenizer.post_processor = processors.ByteLevel(trim_offsets=True)
+        return PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token=start_token, eos_token=start_token,
+                                       unk_token=start_token, add_prefix_space=True)
+
+    start_id = tokenizer.token_to_id(start_token)
+    tokenizer.post_processor = processors.Sequence([
+        processors.ByteLevel(trim_offsets=False),
+        processors.TemplateProcessing(single=f'{start_token} $A', special_tokens=[(start_token, start_id)]),
+    ])
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token=start_token, eos_token=start_token,
+                                   padding_side='left')
+
+
+def make_model(kind, hidden_size=128, layers=2):
+    """
+    A randomly initialized GPT-2-style or Llama-style causal LM with its
+    tokenizer. Returns (model, tokenizer, chosen_model), where chosen_model
+    is the name surprisal.py gets (it decides the tokenization style).
+    """
+    import torch
+    from transformers import GPT2Config, GPT2LMHeadModel, LlamaConfig, LlamaForCausalLM
+
+    torch.manual_seed(0)
+    if kind == 'gpt2':
+        tokenizer = train_tokenizer('<|endoftext|>', prefix_space=True)
+        model = GPT2LMHeadModel(GPT2Config(vocab_size=len(tokenizer), n_positions=1024, n_embd=hidden_size,
+                                           n_layer=layers, n_head=4))
+        chosen_model = 'gpt2-tiny'
+    elif kind == 'llama':
+        tokenizer = train_tokenizer('<|begin_of_text|>', prefix_space=False)
+        model = LlamaForCausalLM(LlamaConfig(vocab_size=len(tokenizer), hidden_size=hidden_size,
+                                             intermediate_size=hidden_size * 2, num_hidden_layers=layers,
+                                             num_attention_heads=4, num_key_value_heads=2,
+                                             max_position_embeddings=2048))
+        chosen_model = 'llama-tiny'
+    else:
+        raise ValueError(f"Unknown model kind '{kind}', choose gpt2 or llama.")
+    model.eval()
+    return model, tokenizer, chosen_model
+
+
+def count_tokens(sentences, tokenizer, llama):
+    return sum(len(ids) for s in sentences
+               for ids, _, _ in surprisal.encode_sequence(s, tokenizer, llama))
+
+
+def run_path(path, sentences, model, tokenizer, chosen_model, workdir, batch_size=16, window=64):
+    """
+    Score the sentences once through one path. Returns the total time and
+    the time spent in each stage (see surprisal_profiler.py), in seconds.
+    """
+    llama = 'llama' in chosen_model
+
+    options = {'single': {},
+               'batched': {'batch_size': batch_size},
+               'prefix': {'share_prefix': True},
+               'window': {'sliding_window': True, 'window': window, 'stride': window // 2},
+               'file': {'batch_size': batch_size}}[path]
+
+    if path == 'file':
+        filename = os.path.join(workdir, f'{chosen_model}.csv')
+        pd.DataFrame({'FullSentence': sentences}).to_csv(filename, index=False)
+
+    # silence the per-row target printout
+    with contextlib.redirect_stdout(io.StringIO()):
+        profiler.enable()
+        start = time.perf_counter()
+        if path == 'file':
+            surprisal.get_surprisal_file(model, tokenizer, chosen_model, filename, **options)
+        else:
+            surprisal.get_surprisal_many(sentences, model, tokenizer, llama=llama, **options)
+        seconds = time.perf_counter() - start
+        stages = {name: stage['seconds'] for name, stage in profiler.report()['stages'].items()}
+        profiler.disable()
+    return seconds, stages
+
+
+def benchmark(kinds=('gpt2', 'llama'), sentence_sets=None, paths=PATHS, repeat=3, batch_size=16):
+    """
+    Run all combinations of model kind, sentence set and path. Every run is
+    repeated and the fastest repetition is kept (the others mostly measure
+    noise from other processes).
+
+    Returns a list of result dicts.
+    """
+    import torch
+
+    if sentence_sets is None:
+        sentence_sets = list(SENTENCE_SETS)
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for kind in kinds:
+            model, tokenizer, chosen_model = make_model(kind)
+            llama = 'llama' in chosen_model
+            for set_name in sentence_sets:
+                sentences = make_sentences(*SENTENCE_SETS[set_name])
+                n_tokens = count_tokens(sentences, tokenizer, llama)
+                for path in paths:
+                    with torch.no_grad():
+                        # one warm-up run
+                        run_path(path, sentences[:8], model, tokenizer, chosen_model, workdir, batch_size)
+                        runs = [run_path(path, sentences, model, tokenizer, chosen_model, workdir, batch_size)
+                                for _ in range(repeat)]
+                    seconds, stages = min(runs, key=lambda run: run[0])
+                    result = {'model': chosen_model,
+                              'sentence_set': set_name,
+                              'path': path,
+                              'n_sentences': len(sentences),
+                              'n_tokens': n_tokens,
+                              'seconds': seconds,
+                              'sentences_per_sec': len(sentences) / seconds,
+                              'tokens_per_sec': n_tokens / seconds,
+                              'stages': stages,
+                              'peak_rss_mb': surprisal.get_peak_rss_mb()}
+                    results.append(result)
+                    print(f"{chosen_model:11} {set_name:11} {path:8} "
+                          f"{result['sentences_per_sec']:9.1f} sent/s {result['tokens_per_sec']:10.1f} tok/s")
+            del model
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        usage=f"{sys.argv[0]} [--output FILE] [--models gpt2,llama] [--paths {','.join(PATHS)}]"
+              " [--repeat N] [--quick]")
+    parser.add_argument('--output', default='benchmark_surprisal.json',
+                        help='JSON file for the results (default: benchmark_surprisal.json)')
+    parser.add_argument('--models', default='gpt2,llama',
+                        help='comma-separated model kinds to benchmark (default: gpt2,llama)')
+    parser.add_argument('--paths', default=','.join(PATHS),
+                        help=f'comma-separated scoring paths (default: {",".join(PATHS)})')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='repetitions per run; the fastest is reported (default: 3)')
+    parser.add_argument('--batch-size', type=int, default=16,
+                        help='batch size of the batched and file paths (default: 16)')
+    parser.add_argument('--quick', action='store_true',
+                        help=f'only run the sentence sets {", ".join(QUICK_SENTENCE_SETS)}')
+    args = parser.parse_args()
+
+    kinds = [k.strip() for k in args.models.split(',')]
+    paths = [p.strip() for p in args.paths.split(',')]
+    for path in paths:
+        if path not in PATHS:
+            parser.error(f'Unknown path {path}, choose from: {", ".join(PATHS)}.')
+
+    # keep the library warnings about the random fixtures out of the table
+    from transformers.utils import logging
+    logging.set_verbosity_error()
+
+    results = benchmark(kinds, QUICK_SENTENCE_SETS if args.quick else None, paths,
+                        repeat=args.repeat, batch_size=args.batch_size)
+    with open(args.output, 'w') as file:
+        environment = get_environment(['torch', 'transformers'],
+                                      torch_threads=surprisal.torch.get_num_threads())
+        json.dump({'environment': environment, 'results': results}, file, indent=2)
+    print(f'\nWriting to file: {args.output}')
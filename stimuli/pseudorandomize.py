@@ -9,7 +9,12 @@ pseudo-random order over the rows in this file.
 The output is the pseudorandomized file.
 
 The criteria for pseudorandomization must be specified in a file
-named "pseudorandomization_constraints.txt" located in the same directory.
+named "pseudorandomization_constraints_single.txt" located in the same
+directory (see parse_rules for the format: maximal run lengths, minimal
+distances and fixed positions). Its Position rules start every block with
+a filler with a question, followed by two more fillers.
+(pseudorandomize_many_orders.py reads pseudorandomization_constraints.txt,
+which starts its blocks differently.)
 
 USAGE:
 python pseudorandomize.py <input files>
@@ -24,16 +29,137 @@ import os
 import pandas as pd
 import numpy as np
 import random
+import math
+import time
 
 
-def read_constraints(filename):
+# How strongly candidates that use up the slack of a constraint (see
+# get_slack) are avoided; 0 only excludes guaranteed dead ends
+LOOKAHEAD = 8
+
+# How strongly a constraint whose slack has fallen behind its share at the
+# start is pulled back: rows that are blocked more often than others (e.g.
+# items, by their conditions and by the runs of items) would otherwise pile
+# up towards the end of long lists, where they leave no room
+CATCH_UP = 40
+
+# Bound on the cached eligible keys per combination of blocked values
+# (number of combinations times number of keys)
+MAX_CACHED_KEYS = 10000000
+
+# Random rows tried per placement before all rows of the chosen key are
+# checked against the Distance rules of columns outside the keys
+ROW_TRIES = 8
+
+# Factor by which the backtracks allowed per attempt grow after every
+# restart, so that an attempt eventually searches the whole tree (and
+# finds that no order exists, if so)
+RESTART_GROWTH = 2
+
+
+def parse_positions(text):
     """
-    Function that reads in a file specifying the constraints for
-    pseudorandomization.
-    The must be a text file named pseudorandomization_constraints.txt
-    containing lines of the structure:
-    Constraint <constraintname> <max_n>
-    E.g.: Constraint Condition 2
+    Function that reads the positions of a rule: a position ("1"), a range
+    ("2-3") or several of them separated by commas ("1,5-7").
+    Positions count from 1.
+
+    Returns:
+    positions (list): the positions in increasing order.
+    """
+    positions = set()
+    for part in text.split(","):
+        first, _, last = part.partition("-")
+        first = int(first)
+        last = int(last) if last else first
+        if first < 1 or last < first:
+            raise ValueError(f"invalid positions: {text}")
+        positions.update(range(first, last + 1))
+    return sorted(positions)
+
+
+def parse_condition(text):
+    """
+    Function that reads a condition of a Position rule:
+    <column>=<value> (the cell is exactly value) or
+    <column>~<text> (the cell contains text).
+
+    Returns:
+    (column, operator, value) tuple.
+    """
+    for operator in ("=", "~"):
+        column, found, value = text.partition(operator)
+        if found and column and value:
+            return column, operator, value
+    raise ValueError(f"invalid condition: {text}")
+
+
+def parse_rules(lines, source="the constraints file"):
+    """
+    Function that reads pseudorandomization rules, one per line.
+    Empty lines and everything after a # are ignored.
+
+    Constraint <column> <max_n> [<positions>]
+        At most max_n rows in a row have the same value in column (empty
+        cells are skipped). With positions, the limit only applies to the
+        rows placed at these positions and replaces the general limit there.
+    Distance <column> <min_distance>
+        Two rows with the same value in column are at least min_distance
+        positions apart (2: never next to each other).
+    Position <positions> <condition> [<condition> ...] [fixed]
+        The rows at these positions match all conditions
+        (<column>=<value> or <column>~<text>, see parse_condition).
+        With fixed, a single position is always filled with the same
+        matching row (drawn with random_state=42, like pandas' sample).
+
+    E.g.:
+    Constraint Condition 2
+    Distance TargetNoun 5
+    Position 1 Type~Filler HasQuestion=Yes fixed
+
+    Returns:
+    rules (list): one dict per rule, with the key "rule" giving its kind.
+    """
+    rules = []
+    for number, line in enumerate(lines, 1):
+        words = line.split("#")[0].split()
+        if not words:
+            continue
+        try:
+            if words[0] == "Constraint" and len(words) in (3, 4):
+                rules.append({"rule": "Constraint",
+                              "column": words[1],
+                              "max_run": int(words[2]),
+                              "positions": (parse_positions(words[3])
+                                            if len(words) == 4 else None)})
+            elif words[0] == "Distance" and len(words) == 3:
+                rules.append({"rule": "Distance",
+                              "column": words[1],
+                              "min_distance": int(words[2])})
+            elif words[0] == "Position" and len(words) >= 3:
+                fixed = words[-1] == "fixed"
+                conditions = [parse_condition(word)
+                              for word in words[2:len(words) - fixed]]
+                positions = parse_positions(words[1])
+                if not conditions or (fixed and len(positions) > 1):
+                    raise ValueError("invalid Position rule")
+                rules.append({"rule": "Position",
+                              "positions": positions,
+                              "conditions": conditions,
+                              "fixed": fixed})
+            else:
+                raise ValueError("unknown rule")
+        except ValueError as e:
+            raise ValueError(
+                f"\n\033[31mCould not read line {number} of {source} "
+                f"({e}): {line.strip()}\033[0m"
+            )
+    return rules
+
+
+def read_rules(filename):
+    """
+    Function that reads in a file specifying the rules for
+    pseudorandomization (see parse_rules for the format).
     """
     if not os.path.isfile(filename):
         raise FileNotFoundError(
@@ -42,96 +168,893 @@ def read_constraints(filename):
         )
 
     with open(filename, 'r') as file:
-        constraints = {}
-        for line in file:
-            line = line.strip().split()
-            if line[0] == "Constraint":
-                constraints[line[1]] = int(line[2])
+        return parse_rules(file, filename)
+
+
+def read_constraints(filename):
+    """
+    Function that reads in a file specifying the constraints for
+    pseudorandomization.
+    The must be a text file named pseudorandomization_constraints.txt
+    containing lines of the structure:
+    Constraint <constraintname> <max_n>
+    E.g.: Constraint Condition 2
 
-    return constraints
+    Only the general maximal run lengths are returned (see read_rules for
+    all rules).
+    """
+    return {rule["column"]: rule["max_run"]
+            for rule in read_rules(filename)
+            if rule["rule"] == "Constraint" and rule["positions"] is None}
 
 
-def pseudorandomize(df, df_output,
-                    constraints,
-                    n=None,
-                    max_depth=1000, recursion_depth=0):
+def encode_constraints(df, df_output, constraints):
     """
-    Recursive function that generates a pseudorandomized data frame
-    according to diverse maximal repeptition criteria.
+    Function that integer-encodes the constraint columns once, so that the
+    pseudorandomization can work on arrays instead of data frames.
 
     Parameters:
     df (dataframe): The dataframe containing the items to be added.
-    df_output (dataframe): The dataframe to which items should be appended.
-    constraints (dict): A dictionary containing the name of the column on which
-                        to apply a constraint as keys, and the constraint
-                        specifications as values.
-    n (int): number of items to be added to df_output from df. Default: n=None,
-             in which case the number of rows in the data frame will be used.
-    max_depth (int): maximum number of attempts to start pseudorandomization
-                     from scratch (to avoid infinite loops).
-    recursion_depth (int): counter for the current number of recursive function
-                           calls (should always be initiated as 0).
+    df_output (dataframe): The dataframe to which items will be appended.
+    constraints (dict or list): the constrained columns (e.g. a dict
+                                column name -> maximal run length).
 
     Returns:
-    df_target (dataframe): The original df_output plus the newly added lines.
+    codes (array): rows of df x constraints; the code of every value, with
+                   -1 for empty cells (which never count towards a run).
+    run_values (list): per constraint, the code of the last non-empty value
+                       in df_output (-1 if there is none).
+    run_lengths (list): per constraint, how often that value occurs in a row
+                        at the end of df_output (ignoring empty cells).
     """
+    codes = np.empty((len(df), len(constraints)), dtype=np.int64)
+    run_values, run_lengths = [], []
+    for c, property in enumerate(constraints):
+        values, _ = pd.factorize(pd.concat([df_output[property], df[property]],
+                                           ignore_index=True))
+        previous = values[:len(df_output)]
+        codes[:, c] = values[len(df_output):]
 
-    df_current = df.copy()
-    df_target = df_output.copy()
+        previous = previous[previous >= 0]
+        run_value, run_length = -1, 0
+        if len(previous) > 0:
+            run_value = previous[-1]
+            changes = np.flatnonzero(previous != run_value)
+            run_length = len(previous) - (changes[-1] + 1 if len(changes) else 0)
+        run_values.append(int(run_value))
+        run_lengths.append(int(run_length))
+    return codes, run_values, run_lengths
 
-    if n is None:
-        n = len(df)
 
-    j = 0
+class NoSolutionError(Exception):
+    """
+    Raised when no pseudorandom order could be found; the message gives
+    the reason (no order exists, or the search budget ran out) and stats
+    the search statistics up to that point (see solve_order).
+    """
+
+    def __init__(self, message, stats=None):
+        super().__init__(message)
+        self.stats = stats
+
+
+class ValueCounts:
+    """
+    Number of remaining rows per value of one column (empty cells left
+    out), with their total and the largest count. Removing or adding one
+    row takes constant time: the number of values with each count is kept,
+    so the largest count drops only when no value has it any more.
+    """
+
+    def __init__(self, counts):
+        self.counts = dict(counts)
+        self.total = sum(self.counts.values())
+        self.max = max(self.counts.values(), default=0)
+        self.values_with = [0] * (self.max + 1)
+        for count in self.counts.values():
+            self.values_with[count] += 1
+
+    def get(self, value):
+        return self.counts.get(value, 0)
+
+    def remove(self, value):
+        count = self.counts[value]
+        self.values_with[count] -= 1
+        self.values_with[count - 1] += 1
+        self.counts[value] = count - 1
+        self.total -= 1
+        if count == self.max and not self.values_with[count]:
+            self.max -= 1
+
+    def add(self, value):
+        count = self.counts[value]
+        self.values_with[count] -= 1
+        self.values_with[count + 1] += 1
+        self.counts[value] = count + 1
+        self.total += 1
+        self.max = max(self.max, count + 1)
+
+    def max_after_removing(self, value):
+        """The largest count after removing one row with value."""
+        if self.counts[value] == self.max and self.values_with[self.max] == 1:
+            return self.max - 1
+        return self.max
+
+
+def get_slack(counts, max_run, run_value, run_length, placed=None):
+    """
+    Function that measures how far the remaining rows of one constraint are
+    from a guaranteed dead end.
+
+    A value with count c can only be placed if the other (non-empty) values
+    can split it into runs of at most max_run rows: the run that is going on
+    can take max_run - run_length more rows, and every other row opens a gap
+    for another run. The slack of a value is the number of rows it could
+    still take beyond c; a negative slack means that the remaining rows
+    cannot be interleaved. This is a necessary condition only (the
+    constraints are checked separately). Only the value of the run and the
+    most frequent value can have the smallest slack, so this takes constant
+    time.
+
+    Parameters:
+    counts (ValueCounts): the remaining rows of the constraint.
+    max_run (int): maximal run length of the constraint.
+    run_value, run_length (int): the current run of the constraint.
+    placed (int): if given, the slack after placing one more row with this
+                  value (counts are left unchanged).
+
+    Returns:
+    slack (int): the smallest slack of any value.
+    """
+    total, max_count = counts.total, counts.max
+    if placed is not None:
+        total -= 1
+        max_count = counts.max_after_removing(placed)
+        if placed == run_value:
+            run_length += 1
+        else:
+            run_value, run_length = placed, 1
+    run_count = counts.get(run_value) - (placed is not None)
+    slack = max_run + max_run * total - (max_run + 1) * max_count
+    if run_count > 0:
+        # An earlier, higher limit for some positions can leave a run
+        # longer than max_run; it cannot take more rows, but is no dead end
+        slack = min(slack, max(max_run - run_length, 0) + max_run * total
+                    - (max_run + 1) * run_count)
+    return slack
+
 
-    while j < n:
+def find_infeasible_value(value_counts, max_runs, values, lengths):
+    """
+    Function that checks whether the remaining rows can still be
+    interleaved under the maximal run lengths, one constraint at a time
+    (see get_slack).
+
+    Parameters:
+    value_counts (list): per constraint, a ValueCounts of the remaining rows.
+    max_runs (list): maximal run length per constraint.
+    values, lengths (list): the current run per constraint.
+
+    Returns:
+    None if the counts can be interleaved, otherwise a tuple
+    (constraint index, value code, count, number of other rows).
+    """
+    for c, counts in enumerate(value_counts):
+        if get_slack(counts, max_runs[c], values[c], lengths[c]) >= 0:
+            continue
+        # the value of the run, or else the most frequent value
+        value = values[c]
+        first_run = max(max_runs[c] - lengths[c], 0)
+        if counts.get(value) <= first_run + max_runs[c] * (counts.total
+                                                           - counts.get(value)):
+            value = max(counts.counts, key=counts.counts.get)
+        count = counts.get(value)
+        return c, value, count, counts.total - count
+    return None
+
+
+class DistanceChecker:
+    """
+    Checks a Distance rule during the search: rows with the same value in
+    one column are at least min_distance positions apart. Keeps the last
+    position of every value, so that checking a candidate, placing a row
+    and undoing it take constant time. When all rows are placed, the search
+    also backtracks as soon as the most frequent value has more rows left
+    than fit into the remaining positions.
+
+    If the column is constrained (column: its index in the codes), whole
+    keys are checked (allows). Otherwise, the column is left out of the
+    keys, which would otherwise be as many as the values (e.g. one target
+    noun per item), and solve_order checks the rows of the chosen key one
+    by one (allows_row).
+    """
+
+    def __init__(self, values, min_distance, last_positions, name,
+                 column=None):
+        self.values = values
+        self.column = column
+        self.per_row = column is None
+        self.min_distance = min_distance
+        self.initial = last_positions
+        self.name = name
+        self.n = 0
+        self.value_counts = {}
+        self.shared = set()
+        self.place_all = False
+        self.reset()
+
+    def reset(self):
+        self.last = dict(self.initial)
+        self.saved = []
+        self.remaining = ValueCounts(self.value_counts)
 
-        # Subset the available items
-        eligible = df_current.copy()
+    def check(self, codes, n):
+        values, counts = np.unique(self.values, return_counts=True)
+        self.value_counts = {value: count for value, count
+                             in zip(values.tolist(), counts.tolist())
+                             if value >= 0}
+        self.shared = {value for value, count in self.value_counts.items()
+                       if count > 1 or value in self.initial}
+        self.n = n
+        self.place_all = n == len(self.values)
+        self.reset()
+        if self.place_all and not self.feasible(-1):
+            return (f"{self.name}: {self.remaining.max} rows share one value, "
+                    f"but {n} positions are too few to keep them "
+                    f"{self.min_distance} positions apart.")
+        return None
 
-        # Subset conditions
-        for property, max_val in constraints.items():
+    def allows_value(self, value, position):
+        return (value < 0 or position - self.last.get(value, -self.min_distance)
+                >= self.min_distance)
 
-            # Extract the last relevant values from the data frame and
-            # filter out any empty strings:
-            prev = df_target.loc[df_target[property].notna(), property]\
-                            .tail(max_val).tolist()
+    def allows(self, key, position):
+        return self.allows_value(key[self.column], position)
 
-            # Subset the set of eligible remaining items based on the above:
-            if len(set(prev)) == 1 and len(prev) >= max_val:
-                eligible = eligible[eligible[property] != prev[0]]
+    def allows_row(self, row, position):
+        return self.allows_value(self.values[row], position)
 
-        # Restart if no eligible rows remain (or quit if limit reached)
-        if eligible.empty:
-            recursion_depth += 1
-            if recursion_depth < max_depth:
-                print(f"No remaining rows. Starting from scratch. Round no: \
-                {recursion_depth + 1}", end="\r")
-                return pseudorandomize(df, df_output,
-                                       constraints,
-                                       n=n,
-                                       max_depth=max_depth,
-                                       recursion_depth=recursion_depth)
+    def get_value(self, key, row):
+        return self.values[row] if self.per_row else key[self.column]
+
+    def get_class(self, row):
+        # Rows whose value no other row has are never blocked and block
+        # nothing, so they are interchangeable
+        value = self.values[row]
+        return value if value in self.shared else -1
+
+    def place(self, key, row, position):
+        value = self.get_value(key, row)
+        if value >= 0:
+            self.saved.append(self.last.get(value))
+            self.last[value] = position
+            self.remaining.remove(value)
+
+    def undo(self, key, row, position):
+        value = self.get_value(key, row)
+        if value >= 0:
+            self.remaining.add(value)
+            previous = self.saved.pop()
+            if previous is None:
+                del self.last[value]
             else:
-                sys.exit(
-                    "\n\033[31mExceeded maximum recursion depth "
-                    "without finding a solution. Exiting function.\033[0m\n"
-                )
+                self.last[value] = previous
 
-        # Shuffle the chosen items, but make reproducible with a random seed
-        current_seed = random.randint(1, 1234) - 1
-        eligible = eligible.sample(frac=1, random_state = current_seed)\
-            .reset_index(drop=True)
+    def feasible(self, position):
+        positions_left = self.n - 1 - position
+        return (not self.place_all or not self.remaining.max
+                or (self.remaining.max - 1) * self.min_distance
+                < positions_left)
 
-        # Append the first row to the dataframe
-        df_target = pd.concat([df_target, eligible.iloc[[0]]],ignore_index=True)
-        df_current = df_current[~df_current["ItemNum"]\
-                        .isin(df_target["ItemNum"])]
 
-        j += 1
+class PositionChecker:
+    """
+    Checks a Position rule during the search: the rows at some positions
+    have a 1 in one column of the codes. Counts the matching rows that are
+    left, so that the search backtracks as soon as there are fewer of them
+    than rule positions still to fill.
+    """
 
-    return df_target
+    def __init__(self, column, positions, n, name):
+        self.column = column
+        self.positions = set(positions)
+        # number of rule positions after each position
+        self.positions_after = [0] * n
+        for position in range(n - 2, -1, -1):
+            self.positions_after[position] = (self.positions_after[position + 1]
+                                              + (position + 1 in self.positions))
+        self.name = name
+        self.per_row = False
+        self.n_matching = 0
+
+    def reset(self):
+        self.matching = self.n_matching
 
+    def check(self, codes, n):
+        self.n_matching = int((codes[:, self.column] == 1).sum())
+        if self.n_matching < len(self.positions):
+            return (f"{self.name}: {len(self.positions)} positions, but only "
+                    f"{self.n_matching} matching rows.")
+        return None
+
+    def allows(self, key, position):
+        return position not in self.positions or key[self.column] == 1
+
+    def place(self, key, row, position):
+        self.matching -= key[self.column] == 1
+
+    def undo(self, key, row, position):
+        self.matching += key[self.column] == 1
+
+    def feasible(self, position):
+        return self.matching >= self.positions_after[position]
+
+
+def match_conditions(df, conditions):
+    """
+    Function that finds the rows of df that match all conditions of a
+    Position rule (see parse_condition).
+
+    Returns:
+    mask (array): True for the matching rows.
+    """
+    mask = np.ones(len(df), dtype=bool)
+    for column, operator, value in conditions:
+        cells = df[column].astype(str)
+        if operator == "=":
+            mask &= (cells == value).to_numpy()
+        else:
+            mask &= cells.str.contains(value, regex=False).to_numpy()
+    return mask
+
+
+def compile_rules(df, df_output, rules, n):
+    """
+    Function that compiles the rules for appending n rows of df to
+    df_output into integer codes and incremental checkers.
+
+    The codes have one column per constrained column (maximal run lengths,
+    checked by solve_order itself), then one per Position rule (1 for the
+    rows that match it). Columns that only have a Distance rule are not
+    part of the codes (see DistanceChecker).
+    Positions in the rules count from the first row of df_output.
+
+    Parameters:
+    df (dataframe): The dataframe containing the items to be added.
+    df_output (dataframe): The dataframe to which items will be appended.
+    rules (list): see parse_rules.
+    n (int): number of rows to be added.
+
+    Returns:
+    codes (array): rows of df x code columns.
+    max_runs (list): per constrained column, the maximal run length, or a
+                     list with the maximal run length at each of the n
+                     positions when some Constraint rules have positions.
+    run_values, run_lengths (list): see encode_constraints.
+    checkers (list): DistanceChecker and PositionChecker objects.
+    names (list): the constrained columns.
+    """
+    offset = len(df_output)
+    no_limit = n + 1
+
+    def relative(positions):
+        return [p - 1 - offset for p in positions if 0 <= p - 1 - offset < n]
+
+    run_rules = [rule for rule in rules if rule["rule"] == "Constraint"]
+    names = list(dict.fromkeys(rule["column"] for rule in run_rules))
+    max_runs = []
+    for column in names:
+        limits = [no_limit] * n
+        # general limits first, then the ones for given positions
+        for rule in sorted((rule for rule in run_rules
+                            if rule["column"] == column),
+                           key=lambda rule: rule["positions"] is not None):
+            if rule["positions"] is None:
+                limits = [rule["max_run"]] * n
+            else:
+                for position in relative(rule["positions"]):
+                    limits[position] = rule["max_run"]
+        max_runs.append(limits[0] if len(set(limits)) == 1 else limits)
+
+    codes, run_values, run_lengths = encode_constraints(df, df_output, names)
+
+    checkers = []
+    for rule in rules:
+        if rule["rule"] != "Distance":
+            continue
+        column = rule["column"]
+        # the same codes as encode_constraints
+        values, _ = pd.factorize(pd.concat([df_output[column], df[column]],
+                                           ignore_index=True))
+        last_positions = {value: position - offset
+                          for position, value in enumerate(values[:offset])
+                          if value >= 0}
+        checkers.append(DistanceChecker(
+            values[offset:], rule["min_distance"], last_positions,
+            f"Distance {column}",
+            names.index(column) if column in names else None))
+
+    position_codes = []
+    for rule in rules:
+        if rule["rule"] != "Position":
+            continue
+        mask = match_conditions(df, rule["conditions"])
+        if rule["fixed"] and mask.any():
+            # always the same row, as df[mask].sample(1, random_state=42)
+            chosen = df[mask].reset_index(drop=True).sample(1, random_state=42)
+            fixed = np.zeros(len(df), dtype=bool)
+            fixed[np.flatnonzero(mask)[chosen.index[0]]] = True
+            mask = fixed
+        position_codes.append(mask.astype(np.int64))
+        description = " ".join(f"{column}{operator}{value}" for column,
+                               operator, value in rule["conditions"])
+        checkers.append(PositionChecker(codes.shape[1] + len(position_codes) - 1,
+                                        relative(rule["positions"]), n,
+                                        f"Position {description}"))
+    if position_codes:
+        codes = np.column_stack([codes] + position_codes)
+
+    return codes, max_runs, run_values, run_lengths, checkers, names
+
+
+def solve_order(codes, max_runs, run_values, run_lengths, n,
+                max_nodes=1000000, time_limit=None, max_backtracks=None,
+                lookahead=LOOKAHEAD, catch_up=CATCH_UP, names=None,
+                checkers=()):
+    """
+    Function that finds a pseudorandom order of n rows under maximal
+    repetition criteria, working on integer codes only.
+
+    Rows with the same combination of codes are interchangeable for the
+    constraints, so the search places combinations ("keys") and the rows of
+    each key are shuffled afterwards. At every position, the keys whose
+    values are not blocked by a run at its maximum length are tried in
+    random order, weighted by their remaining number of rows. Other rules
+    (see compile_rules) are checked by the checkers: a candidate must be
+    allowed by every checker, and after each placement every checker must
+    still find the rest feasible. Checkers of columns outside the codes
+    (Distance rules on unconstrained columns) check rows instead: a random
+    allowed row of the chosen key is placed, and when the search comes
+    back to that position, the other rows of the key are tried after the
+    other keys (only one of the rows with the same values for these
+    checkers, as they are interchangeable).
+
+    When all remaining rows are to be placed, every candidate is also
+    checked ahead: for each constraint, the slack of the remaining counts
+    after placing it (see get_slack). Candidates that lead to a guaranteed
+    dead end (negative slack) are excluded, and the weight of the others is
+    multiplied by (slack after + 1) / (slack before + 1) per constraint, to
+    the power of lookahead. Values that fall behind (e.g. one condition
+    that is left over at the end of the list) are thus placed earlier, and
+    unconstrained lists are still drawn nearly uniformly. This only acts
+    once the slack is small, which in long lists is too late: rows that
+    are blocked more often than others are drawn less than their share
+    all along. So when the slack of a constraint falls behind its share
+    of the remaining rows at the start, the weights are also multiplied by
+    exp(catch_up * shortfall * change in slack / maximal run length), where
+    the shortfall is the missing fraction of that share.
+
+    If the next position has no candidate, the placement is undone and the
+    next candidate is tried; when a position has no candidates left, the
+    search backtracks one position. After max_backtracks backtracks, the
+    search starts from scratch with a new random order, and the number of
+    backtracks allowed grows by RESTART_GROWTH with every restart, so the
+    search stays complete: if no order exists, an attempt eventually tries
+    every possible order and says so.
+
+    Random numbers come from the random module (see random.seed).
+
+    Parameters:
+    codes (array): rows x code columns, see compile_rules; the first
+                   columns are the constrained columns.
+    max_runs (list): maximal run length per constraint, or a list with the
+                     maximal run length at each position.
+    run_values, run_lengths (list): run state at the start of the order,
+                                    see encode_constraints.
+    n (int): number of rows to place.
+    max_nodes (int): maximal number of placements to try in total.
+    time_limit (float): maximal search time in seconds (None: no limit).
+    max_backtracks (int): backtracks of the first attempt before starting
+                          from scratch (None: n); later attempts allow
+                          more (see RESTART_GROWTH).
+    lookahead (float): how strongly candidates that use up slack are
+                       avoided (0: only exclude dead ends).
+    catch_up (float): how strongly constraints whose slack fell behind are
+                      pulled back (0: not at all).
+    names (list): constraint names, for the error messages.
+    checkers (list): see compile_rules.
+
+    Returns:
+    order (list): the positions of the placed rows in codes, in order.
+    stats (dict): number of attempts, restarts (attempts - 1), placements
+                  tried (nodes) and backtracks; per position, the number
+                  of rows that can be placed there (eligible_rows_mean,
+                  eligible_rows_min) and of the distinct code combinations
+                  they have (eligible_keys_mean, eligible_keys_min), over
+                  eligible_steps positions; the search time (seconds).
+
+    Raises:
+    NoSolutionError: if no order exists or the budget is exhausted (with
+                     the stats so far).
+    """
+    start_time = time.perf_counter()
+    if names is None:
+        names = [f"constraint {c}" for c in range(len(max_runs))]
+    if max_backtracks is None:
+        max_backtracks = max(n, 1)
+
+    keys, key_of_row = np.unique(codes, axis=0, return_inverse=True)
+    key_of_row = key_of_row.reshape(-1)
+    keys = keys.tolist()
+    rows_per_key = [np.flatnonzero(key_of_row == k).tolist()
+                    for k in range(len(keys))]
+    n_constraints = len(max_runs)
+    place_all = n == len(codes)
+
+    # Maximal run length at each position and, for the slack, the largest
+    # one from each position on
+    limits = [max_run if isinstance(max_run, list) else [max_run] * n
+              for max_run in max_runs]
+    slack_limits = []
+    for column_limits in limits:
+        column_limits = column_limits + (column_limits[-1:] or [1])
+        for position in range(n - 1, -1, -1):
+            column_limits[position] = max(column_limits[position],
+                                          column_limits[position + 1])
+        slack_limits.append(column_limits)
+
+    stats = {"attempts": 0, "nodes": 0, "backtracks": 0, "eligible_steps": 0,
+             "eligible_rows_total": 0, "eligible_rows_min": None,
+             "eligible_keys_total": 0, "eligible_keys_min": None}
+
+    def get_stats():
+        stats["restarts"] = max(stats["attempts"] - 1, 0)
+        for unit in ("rows", "keys"):
+            stats[f"eligible_{unit}_mean"] = (
+                stats[f"eligible_{unit}_total"] / stats["eligible_steps"]
+                if stats["eligible_steps"] else None)
+        stats["seconds"] = time.perf_counter() - start_time
+        return stats
+
+    def describe(problem):
+        c, value, count, others = problem
+        if isinstance(max_runs[c], list):
+            limit = (f"at most {slack_limits[c][0]} in a row where the limit "
+                     "is highest; the limit varies by position")
+        else:
+            limit = f"at most {max_runs[c]} in a row"
+        return (f"{names[c]}: {count} remaining rows share one value, but "
+                f"only {others} other rows can separate them ({limit}).")
+
+    value_counts = [{} for _ in range(n_constraints)]
+    for k, key in enumerate(keys):
+        for c in range(n_constraints):
+            if key[c] >= 0:
+                value_counts[c][key[c]] = (value_counts[c].get(key[c], 0)
+                                           + len(rows_per_key[k]))
+
+    if n > len(codes):
+        raise NoSolutionError(f"Cannot place {n} rows, only {len(codes)} "
+                              "are available.", get_stats())
+    if place_all:
+        problem = find_infeasible_value([ValueCounts(value_count)
+                                         for value_count in value_counts],
+                                        [limit[0] for limit in slack_limits],
+                                        run_values, run_lengths)
+        if problem is not None:
+            raise NoSolutionError("No order exists. " + describe(problem),
+                                  get_stats())
+    for checker in checkers:
+        problem = checker.check(codes, n)
+        if problem is not None:
+            raise NoSolutionError("No order exists. " + problem,
+                                  get_stats())
+
+    # Slack per remaining row of each constraint at the start, under the
+    # limit of the last position
+    slack_shares = [0] * n_constraints
+    if place_all and n:
+        for c in range(n_constraints):
+            start_counts = ValueCounts(value_counts[c])
+            slack_shares[c] = max(get_slack(start_counts, limits[c][-1],
+                                            run_values[c], run_lengths[c]),
+                                  0) / (start_counts.total + 1)
+
+    key_checkers = [checker for checker in checkers if not checker.per_row]
+    row_checkers = [checker for checker in checkers if checker.per_row]
+
+    def get_row_class(k, row):
+        return (k,) + tuple(checker.get_class(row) for checker in row_checkers)
+
+    def draw_row(k, position, tried):
+        # A random row of key k whose class (the key and the values the row
+        # checkers see) was not tried at this position yet and that the row
+        # checkers allow (index in the bucket of k, None if there is none):
+        # a few random tries first, as most rows are allowed
+        bucket = buckets[k]
+
+        def allowed(row):
+            return get_row_class(k, row) not in tried and all(
+                checker.allows_row(row, position) for checker in row_checkers)
+
+        for _ in range(ROW_TRIES):
+            i = random.randrange(len(bucket))
+            if allowed(bucket[i]):
+                return i
+        indices = [i for i, row in enumerate(bucket) if allowed(row)]
+        return random.choice(indices) if indices else None
+
+    # Eligible keys for every combination of blocked values
+    eligible_keys = {}
+
+    def get_candidates(counts, remaining, values, lengths, position):
+        blocked = tuple((c, values[c]) for c in range(n_constraints)
+                        if lengths[c] >= limits[c][position] and values[c] >= 0)
+        if blocked not in eligible_keys:
+            if len(eligible_keys) * len(keys) > MAX_CACHED_KEYS:
+                eligible_keys.clear()
+            eligible_keys[blocked] = [
+                k for k, key in enumerate(keys)
+                if all(key[c] != value for c, value in blocked)
+            ]
+        candidates = [k for k in eligible_keys[blocked] if counts[k] > 0]
+        if key_checkers:
+            candidates = [k for k in candidates
+                          if all(checker.allows(keys[k], position)
+                                 for checker in key_checkers)]
+        weights = [counts[k] for k in candidates]
+
+        if place_all:
+            # Lookahead: the smallest slack left after placing each candidate
+            current = [get_slack(remaining[c], slack_limits[c][position],
+                                 values[c], lengths[c])
+                       for c in range(n_constraints)]
+            # Empty cells leave the run unchanged, but the next position
+            # can have a lower limit
+            unchanged = [get_slack(remaining[c], slack_limits[c][position + 1],
+                                   values[c], lengths[c])
+                         for c in range(n_constraints)]
+            # How far the slack fell behind its share (see catch_up)
+            pressure = []
+            for c in range(n_constraints):
+                share = slack_shares[c] * (remaining[c].total + 1)
+                pressure.append(catch_up * max(share - current[c], 0)
+                                / (share + 1) / slack_limits[c][position + 1])
+            if min(current, default=0) < 0:
+                # Dead end, whatever comes next
+                candidates, weights = [], []
+            after = {}
+            for i, k in enumerate(candidates):
+                for c in range(n_constraints):
+                    value = keys[k][c]
+                    if value < 0:
+                        slack = unchanged[c]
+                    else:
+                        if (c, value) not in after:
+                            after[c, value] = get_slack(
+                                remaining[c], slack_limits[c][position + 1],
+                                values[c], lengths[c], placed=value)
+                        slack = after[c, value]
+                    if slack < 0:
+                        weights[i] = 0
+                        break
+                    weights[i] *= ((slack + 1) / (current[c] + 1)) ** lookahead
+                    if pressure[c]:
+                        weights[i] *= math.exp(pressure[c]
+                                               * (slack - unchanged[c]))
+            candidates = [k for k, w in zip(candidates, weights) if w > 0]
+            weights = [w for w in weights if w > 0]
+
+        stats["eligible_steps"] += 1
+        for unit, size in (("rows", sum(counts[k] for k in candidates)),
+                           ("keys", len(candidates))):
+            stats[f"eligible_{unit}_total"] += size
+            if stats[f"eligible_{unit}_min"] is None or \
+                    size < stats[f"eligible_{unit}_min"]:
+                stats[f"eligible_{unit}_min"] = size
+
+        # Weighted random order; the candidate to try first comes last
+        ranked = sorted(range(len(candidates)),
+                        key=lambda i: random.random() ** (1 / weights[i]))
+        return [candidates[i] for i in ranked]
+
+    attempt_backtracks = max_backtracks
+    while True:
+        stats["attempts"] += 1
+        if stats["attempts"] > 1:
+            attempt_backtracks *= RESTART_GROWTH
+        counts = [len(rows) for rows in rows_per_key]
+        remaining = [ValueCounts(value_count)
+                     for value_count in value_counts]
+        values = list(run_values)
+        lengths = list(run_lengths)
+        path = []      # placed key per position
+        rows = []      # placed row per position (only with row checkers)
+        saved = []     # run state before each placement
+        # Rows of each key that are left (only with row checkers; otherwise
+        # the rows are assigned to the keys at the end)
+        buckets = [list(key_rows) for key_rows in rows_per_key] \
+            if row_checkers else None
+        for checker in checkers:
+            checker.reset()
+        stack = [get_candidates(counts, remaining, values, lengths, 0)
+                 if n else []]
+        tried = [set()]  # row classes tried per position (row checkers)
+        backtracks = 0
+
+        while len(path) < n:
+            if not stack[-1]:
+                # No candidates left at this position: undo the last one
+                stack.pop()
+                tried.pop()
+                if not path:
+                    raise NoSolutionError(
+                        "No order exists: every possible order was tried "
+                        f"({stats['nodes']} placements).", get_stats())
+                k = path.pop()
+                row = rows.pop() if row_checkers else None
+                if row_checkers:
+                    # The other rows of the key are tried after the
+                    # other keys
+                    buckets[k].append(row)
+                    tried[-1].add(get_row_class(k, row))
+                    stack[-1].insert(0, k)
+                values, lengths = saved.pop()
+                counts[k] += 1
+                for c in range(n_constraints):
+                    if keys[k][c] >= 0:
+                        remaining[c].add(keys[k][c])
+                for checker in checkers:
+                    checker.undo(keys[k], row, len(path))
+                stats["backtracks"] += 1
+                backtracks += 1
+                if backtracks > attempt_backtracks:
+                    break
+                continue
+
+            stats["nodes"] += 1
+            if stats["nodes"] > max_nodes:
+                raise NoSolutionError(
+                    f"No order found within {max_nodes} placements "
+                    f"({stats['attempts']} attempts, "
+                    f"{stats['backtracks']} backtracks).", get_stats())
+            if (time_limit is not None
+                    and time.perf_counter() - start_time > time_limit):
+                raise NoSolutionError(
+                    f"No order found within {time_limit} seconds "
+                    f"({stats['attempts']} attempts, "
+                    f"{stats['backtracks']} backtracks).", get_stats())
+
+            # Place the next candidate and update the runs (empty cells
+            # leave them unchanged)
+            k = stack[-1].pop()
+            row = None
+            if row_checkers:
+                i = draw_row(k, len(path), tried[-1])
+                if i is None:
+                    continue
+                bucket = buckets[k]
+                bucket[i], bucket[-1] = bucket[-1], bucket[i]
+                row = bucket.pop()
+                rows.append(row)
+            saved.append((values, lengths))
+            values, lengths = list(values), list(lengths)
+            for c in range(n_constraints):
+                value = keys[k][c]
+                if value < 0:
+                    continue
+                remaining[c].remove(value)
+                if value == values[c]:
+                    lengths[c] += 1
+                else:
+                    values[c] = value
+                    lengths[c] = 1
+            for checker in checkers:
+                checker.place(keys[k], row, len(path))
+            counts[k] -= 1
+            path.append(k)
+
+            # Forward checking (an empty list makes the search backtrack)
+            if len(path) < n:
+                tried.append(set())
+                if all(checker.feasible(len(path) - 1) for checker in checkers):
+                    stack.append(get_candidates(counts, remaining, values,
+                                                lengths, len(path)))
+                else:
+                    stack.append([])
+
+        if len(path) == n:
+            break
+
+    get_stats()
+
+    if row_checkers:
+        return rows, stats
+
+    # Assign the rows of each key in random order
+    buckets = [random.sample(key_rows, len(key_rows))
+               for key_rows in rows_per_key]
+    order = [buckets[k].pop() for k in path]
+    return order, stats
+
+
+def pseudorandomize_order(df, df_output,
+                          constraints,
+                          n=None,
+                          max_nodes=1000000,
+                          time_limit=None):
+    """
+    Function that draws a pseudorandom order of the rows of df, without
+    building the data frame (see pseudorandomize for the parameters).
+
+    Returns:
+    order (array): the positions (as in df.iloc) of the n rows to append
+                   to df_output, in order.
+    stats (dict): search statistics (see solve_order).
+
+    Raises:
+    NoSolutionError: if no order exists or the search budget is exhausted.
+    """
+
+    if n is None:
+        n = len(df)
+
+    if isinstance(constraints, dict):
+        constraints = [{"rule": "Constraint", "column": column,
+                        "max_run": max_run, "positions": None}
+                       for column, max_run in constraints.items()]
+
+    (codes, max_runs, run_values, run_lengths,
+     checkers, names) = compile_rules(df, df_output, constraints, n)
+    order, stats = solve_order(codes, max_runs,
+                               run_values, run_lengths, n,
+                               max_nodes=max_nodes, time_limit=time_limit,
+                               names=names, checkers=checkers)
+    return np.array(order, dtype=np.int64), stats
+
+
+def pseudorandomize(df, df_output,
+                    constraints,
+                    n=None,
+                    max_nodes=1000000,
+                    time_limit=None,
+                    return_stats=False):
+    """
+    Function that generates a pseudorandomized data frame
+    according to diverse maximal repetition criteria
+    (see solve_order for the algorithm).
+
+    Parameters:
+    df (dataframe): The dataframe containing the items to be added.
+    df_output (dataframe): The dataframe to which items should be appended.
+    constraints (dict): A dictionary containing the name of the column on which
+                        to apply a constraint as keys, and the constraint
+                        specifications as values. Can also be a list of rules
+                        (see read_rules).
+    n (int): number of items to be added to df_output from df. Default: n=None,
+             in which case the number of rows in the data frame will be used.
+    max_nodes (int): maximal number of placements the search may try.
+    time_limit (float): maximal search time in seconds (None: no limit).
+    return_stats (bool): also return the search statistics of solve_order
+                         (attempts, restarts, nodes, backtracks, eligible
+                         rows and keys, seconds).
+
+    Returns:
+    df_target (dataframe): The original df_output plus the newly added lines.
+    stats (dict): only with return_stats=True.
+
+    Raises:
+    NoSolutionError: if no order exists or the search budget is exhausted.
+    """
+
+    order, stats = pseudorandomize_order(df, df_output, constraints, n,
+                                         max_nodes=max_nodes,
+                                         time_limit=time_limit)
+
+    df_target = pd.concat([df_output, df.iloc[order]], ignore_index=True)
+    if return_stats:
+        return df_target, stats
+    return df_target
 
 
 if __name__ == "__main__":
@@ -146,7 +1069,7 @@ if __name__ == "__main__":
     if not len(file_names) > 0:
         sys.exit("Usage: python pseudorandomize.py <input files>")
 
-    constraints = read_constraints("pseudorandomization_constraints.txt")
+    rules = read_rules("pseudorandomization_constraints_single.txt")
 
     for f in file_names:
 
@@ -159,43 +1082,22 @@ if __name__ == "__main__":
         df["HasQuestion"] = ["No" if pd.isna(x) else x
                              for x in df["HasQuestion"]]
 
-        ### Step 1: Select a first filler with a question ###
-
-        question_fillers = df[(df["Type"].str.contains("Filler")) &
-                              (df["HasQuestion"] == "Yes")]
-        df_output = question_fillers.sample(1, random_state=42)
-        df = df[~df["ItemNum"].isin(df_output["ItemNum"])]  # remove from df
-
 
-        ### Step 2: Select two more fillers to start the block ###
+        ### Distribute the items (block start included) ###
 
-        #TODO: adapt script to allow the start of a block
-        # with some fillers, and then the full pseudorandomization
-        constraints_start = {"ExpCondition": 1, # different conditions each time
-                             "Type": 3, # irrelevant here but needs to be >= n here
-                             "HasQuestion": 2,
-                             "Answer": 2}
-        n = 2
-        max_depth = 5
-
-        fillers = df[df["Type"].str.contains("Filler")]
-
-        df_output = pseudorandomize(fillers, df_output,
-                                    constraints_start,
-                                    n=n, max_depth=max_depth)
-        df = df[~df["ItemNum"].isin(df_output["ItemNum"])]  # remove from df
-
-
-        ### Step 3: Distribute the remaining items ###
-
-        n = len(df)
-        max_depth = 500
+        time_limit = 60  # seconds
 
-        df_output = pseudorandomize(df, df_output,
-                                    constraints,
-                                    n=n, max_depth=max_depth)
-        df = df[~df["ItemNum"].isin(df_output["ItemNum"])]  # remove from df
+        try:
+            df_output, stats = pseudorandomize(df, df.iloc[:0],
+                                               rules,
+                                               time_limit=time_limit,
+                                               return_stats=True)
+        except NoSolutionError as e:
+            sys.exit(f"\n\033[31mCould not pseudorandomize file {f}: "
+                     f"{e}\033[0m\n")
 
+        print(f"Restarts: {stats['restarts']}, "
+              f"backtracks: {stats['backtracks']}")
         print(
               "\n\033[38;5;22mFinished processing file {}. "
               "Writing to file.\033[0m".format(f)
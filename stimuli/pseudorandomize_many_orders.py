@@ -11,240 +11,271 @@ name and the suffix "_pseudorandomized" in the same folder.
 
 This script allows to generate several pseudorandom orders for each file,
 depending on the value of n_randomizations (if n_randomizations > 1).
-Each different order will be appended to the same file.
-The output files' Group column indicates the number of each pseudorandom order.
+All orders of a file are written to the same output file, one after the
+other. The output files' Group column indicates the number of each
+pseudorandom order.
+The orders are drawn with the pseudorandomization engine of
+pseudorandomize.py.
+
+Each file is read and prepared once (see load_list). An order is only a
+permutation of the rows of that table; the output file is built from all
+permutations and written at once when the last order of the file is done.
+With --compact, only the permutations are written, to a file with the
+suffix "_orders": one line per order (Group) with the row numbers of the
+input file in pseudorandom order (see write_orders). Tools that format the
+lists can expand them later (see expand_orders).
+
+Every order has its own random seed, derived from the base seed (--seed),
+the file name and the order number (Group). An order therefore does not
+depend on the other orders or on the number of orders, and can be
+regenerated on its own with generate_order(). With --workers N, the
+(file, order) jobs are spread over N processes; the output is the same for
+any number of workers.
 
 The criteria for pseudorandomization must be specified in a file
 named "pseudorandomization_constraints.txt" located in the same directory
-as this script.
+as this script (see parse_rules in pseudorandomize.py for the format).
+Its Position rules start every order with the same filler, followed by a
+filler that differs from it in HasQuestion.
 
 USAGE:
 python pseudorandomize_many_orders.py <folder> <n_randomizations>
+                                      [--workers N] [--seed N] [--compact]
 
 EXAMPLE:
-python pseudorandomize_many_orders.py pcibex_lists 20
+python pseudorandomize_many_orders.py pcibex_lists 20 --workers 8
 '''
 
 
 import sys
 import os
+import argparse
+import hashlib
+import multiprocessing
 import pandas as pd
 import numpy as np
 import random
 
+from pseudorandomize import read_rules, pseudorandomize_order, NoSolutionError
 
-def read_constraints(filename):
-    """
-    Function that reads in a file specifying the constraints for
-    pseudorandomization.
-    The must be a text file named pseudorandomization_constraints.txt
-    containing lines of the structure:
-    Constraint <constraintname> <max_n>
-    E.g.: Constraint Condition 2
+
+def get_order_seed(base_seed, filename, group):
     """
-    if not os.path.isfile(filename):
-        raise FileNotFoundError(
-            f"\n\033[31mThe file '{filename}' needed to specify the "
-            "constraints was not found in the current directory.\033[0m"
-        )
-
-    with open(filename, 'r') as file:
-        constraints = {}
-        for line in file:
-            line = line.strip().split()
-            if line[0] == "Constraint":
-                constraints[line[1]] = int(line[2])
-
-    return constraints
-
-
-def pseudorandomize(df,
-                    df_output,
-                    constraints,
-                    n=None,
-                    max_depth=1000,
-                    recursion_depth=0):
+    Function that derives the random seed of one order from the base seed,
+    the name of the file (without the folder) and the order number, so that
+    it is the same on every machine and in every process.
     """
-    Recursive function that generates a pseudorandomized data frame
-    according to diverse maximal repeptition criteria.
+    key = f"{base_seed}:{os.path.basename(filename)}:{group}"
+    return int.from_bytes(hashlib.sha256(key.encode("utf-8")).digest()[:8],
+                          "big")
 
-    Parameters:
-    df (dataframe): The dataframe containing the items to be added.
-    df_output (dataframe): The dataframe to which items should be appended.
-    constraints (dict): A dictionary containing the name of the column on which
-                        to apply a constraint as keys, and the constraint
-                        specifications as values.
-    n (int): number of items to be added to df_output from df. Default: n=None,
-             in which case the number of rows in the data frame will be used.
-    max_depth (int): maximum number of attempts to start pseudorandomization
-                     from scratch (to avoid infinite loops).
-    recursion_depth (int): counter for the current number of recursive function
-                           calls (should always be initiated as 0).
 
-    Returns:
-    df_target (dataframe): The original df_output plus the newly added lines.
+def load_list(filepath):
     """
+    Function that reads a list and prepares it for pseudorandomization.
+    This is done once per file; all orders are drawn from the result.
 
-    df_current = df.copy()
-    df_target = df_output.copy()
-
-    if n is None:
-        n = len(df)
-
-    j = 0
-
-    while j < n:
-
-        # Subset the available items
-        eligible = df_current.copy()
-
-        # Subset conditions
-        for property, max_val in constraints.items():
-
-            # Extract the last relevant values from the data frame and
-            # filter out any empty strings:
-            prev = df_target.loc[df_target[property].notna(), property]\
-                            .tail(max_val).tolist()
-
-            # Subset the set of eligible remaining items based on the above:
-            if len(set(prev)) == 1 and len(prev) >= max_val:
-                eligible = eligible[eligible[property] != prev[0]]
-
-        # Restart if no eligible rows remain (or quit if limit reached)
-        if eligible.empty:
-            recursion_depth += 1
-            if recursion_depth < max_depth:
-                # print("No remaining rows. Starting from scratch. Round no: "
-                #       f"{recursion_depth + 1}", end="\r")
-                return pseudorandomize(df,
-                                       df_output,
-                                       constraints,
-                                       n=n,
-                                       max_depth=max_depth,
-                                       recursion_depth=recursion_depth)
-            else:
-                sys.exit(
-                    "\n\033[1;31mExceeded maximum recursion depth "
-                    "without finding a solution. Exiting function.\033[0m\n"
-                )
-
-        # Shuffle the chosen items, but make reproducible with a random seed
-        current_seed = random.randint(1, 1234) - 1
-        eligible = eligible.sample(frac=1, random_state = current_seed)\
-            .reset_index(drop=True)
-
-        # Append the first row to the dataframe
-        df_target = pd.concat([df_target, eligible.iloc[[0]]],ignore_index=True)
-        df_current = df_current[~df_current["ItemNum"]\
-                        .isin(df_target["ItemNum"])]
-
-        j += 1
+    Returns:
+    df (dataframe): the rows of the file.
+    """
+    df = pd.read_csv(filepath)
 
-        # Print in blue if recursion < 100, otherwise red
-        font_color = "\033[1;34m" if recursion_depth < 100-1 else "\033[1;31m"
+    # Replace the empty string in the HasQuestion and Answer columns
+    # to avoid running into NA issues later:
+    df["HasQuestion"] = df["HasQuestion"].fillna("No")
+    return df
 
-        print(f"{font_color}Pseudorandomization attempt no:   "
-              f"{recursion_depth + 1}\033[0m", end="\r")
 
-    return df_target
+def generate_order(df, filename, group, rules, base_seed=42):
+    """
+    Function that generates pseudorandom order no <group> of one file.
 
+    Parameters:
+    df (dataframe): the rows of the file (see load_list).
+    filename (str): the name of the file (for the random seed).
+    group (int): the number of the order.
+    rules (list): see read_rules.
+    base_seed (int): the base random seed (see get_order_seed).
 
+    Returns:
+    order (array): the rows of df (positions as in df.iloc) in
+                   pseudorandom order.
+    stats (dict): search statistics (see solve_order).
 
-if __name__ == "__main__":
+    Raises:
+    NoSolutionError: if no order could be found.
+    """
+    random.seed(get_order_seed(base_seed, filename, group))
 
-    ### Preliminaries ###
+    ### Distribute the items (block start included) ###
 
-    # Set random seed
-    random.seed(42)
+    time_limit = 60  # seconds
 
-    try:
-        directory = sys.argv[1]
-        n_randomizations = int(sys.argv[2])
-    except:
-        sys.exit("Usage: python pseudorandomize.py <folder> <n_randomizations>")
+    return pseudorandomize_order(df, df.iloc[:0], rules,
+                                 time_limit=time_limit)
 
-    constraints = read_constraints("pseudorandomization_constraints.txt")
 
-    files = sorted(os.listdir(directory))
-    files = [f for f in files if f.lower().endswith(".csv")
-             and not "pseudorandomized" in f]
+def build_orders(df, orders, groups):
+    """
+    Function that builds the output table of one file: the rows of df in
+    each order, one order after the other, with the order number in the
+    Group column.
 
-    for f, filename in enumerate(files):
+    Parameters:
+    df (dataframe): the rows of the file (see load_list).
+    orders (list): one permutation of the rows of df per order.
+    groups (list): the order numbers.
 
-        filepath = os.path.join(directory, filename)
+    Returns:
+    df_output (dataframe)
+    """
+    df_output = df.iloc[np.concatenate(orders)].reset_index(drop=True)
+    df_output["Group"] = np.repeat(groups, [len(order) for order in orders])
+    return df_output
 
-        # Remove the output file if it already exists
-        out_filepath = filepath.replace(".csv", "_pseudorandomized.csv")
-        if os.path.exists(out_filepath):
-            os.remove(out_filepath)
 
-        print(f"\nPROCESSING FILE: {filename} (FILE NO {f+1} / {len(files)})")
+def write_orders(orders, groups, out_filepath):
+    """
+    Function that writes the orders of one file in compact form: a .csv file
+    with the columns Group and Rows, where Rows lists the row numbers of the
+    input file (counting the rows below the header from 1) in pseudorandom
+    order, separated by spaces.
+    """
+    pd.DataFrame({
+        "Group": groups,
+        "Rows": [" ".join(map(str, order + 1)) for order in orders],
+    }).to_csv(out_filepath, index=False)
 
-        # Generate r different random orders in each file
-        for r in range(0, n_randomizations):
 
-            current_group = r+1
+def expand_orders(df, df_orders):
+    """
+    Function that expands compact orders (see write_orders) into the output
+    table of the file they were drawn from (see build_orders).
 
-            # Open file
-            df = pd.read_csv(filepath)
+    Parameters:
+    df (dataframe): the rows of the file (see load_list).
+    df_orders (dataframe): the compact orders, e.g. read with pd.read_csv.
 
-            df["Group"] = current_group
+    Returns:
+    df_output (dataframe)
+    """
+    orders = [np.array(rows.split(), dtype=np.int64) - 1
+              for rows in df_orders["Rows"]]
+    return build_orders(df, orders, df_orders["Group"].to_numpy())
 
-            # Replace the empty string in the HasQuestion and Answer columns
-            # to avoid running into NA issues later:
-            df["HasQuestion"] = ["No" if pd.isna(x) else x
-                                 for x in df["HasQuestion"]]
 
+# Tables and rules of the worker processes (see _init_worker)
+_tables = {}
+_job_settings = {}
 
-            ### Step 1: Select a first filler ###
 
-            # question_fillers = df[(df["Type"].str.contains("Filler")) &
-            #                       (df["HasQuestion"] == "Yes")]
-            all_fillers = df[(df["Type"].str.contains("Filler"))]
-            # Sample the same first filler per block for every list
-            # achieved by using the random state.
-            # CAREFUL: This is necessary to ensure reproducibility of the script!!!
-            df_output = all_fillers.sample(1, random_state=42)
-            df = df[~df["ItemNum"].isin(df_output["ItemNum"])]  # remove from df
+def _init_worker(tables, rules, base_seed):
+    _tables.update(tables)
+    _job_settings.update(rules=rules, base_seed=base_seed)
 
 
-            ### Step 2: Select one more filler to start the block ###
+def _generate_job(job):
+    filepath, group = job
+    try:
+        order, stats = generate_order(_tables[filepath], filepath, group,
+                                      _job_settings["rules"],
+                                      _job_settings["base_seed"])
+        return order, stats, None
+    except NoSolutionError as e:
+        return None, None, str(e)
 
-            constraints_start = {"ExpCondition": 1, # different conditions each time
-                                 "Type": 3, # irrelevant but needs to be >= n here
-                                 "HasQuestion": 1, # vary if second filler has Q
-                                 "Answer": 2}  # irrelevant here
-            n = 1  # 1 filler
-            max_depth = 10
 
-            fillers = df[df["Type"].str.contains("Filler")]
+if __name__ == "__main__":
 
-            df_output = pseudorandomize(fillers,
-                                        df_output,
-                                        constraints_start,
-                                        n=n,
-                                        max_depth=max_depth)
-            df = df[~df["ItemNum"].isin(df_output["ItemNum"])]  # remove from df
+    ### Preliminaries ###
 
+    parser = argparse.ArgumentParser(
+        usage=f"{sys.argv[0]} <folder> <n_randomizations> [--workers N] "
+              "[--seed N] [--compact]",
+        epilog=f"EXAMPLE: {sys.argv[0]} pcibex_lists 20 --workers 8")
+    parser.add_argument("directory",
+                        help="folder with the .csv files to pseudorandomize")
+    parser.add_argument("n_randomizations", type=int,
+                        help="number of orders per file")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes (default: 1)")
+    parser.add_argument("--seed", type=int, default=42,
+                        help="base random seed (default: 42)")
+    parser.add_argument("--compact", action="store_true",
+                        help="only write the row numbers of each order "
+                             "(suffix _orders)")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1.")
+    if args.n_randomizations < 1:
+        parser.error("n_randomizations must be at least 1.")
+
+    rules = read_rules("pseudorandomization_constraints.txt")
+
+    files = sorted(os.listdir(args.directory))
+    files = [f for f in files if f.lower().endswith(".csv")
+             and not "pseudorandomized" in f and not "_orders" in f]
+
+    # Every file is read once
+    tables = {os.path.join(args.directory, filename):
+              load_list(os.path.join(args.directory, filename))
+              for filename in files}
+
+    groups = list(range(1, args.n_randomizations + 1))
+    jobs = [(os.path.join(args.directory, filename), group)
+            for filename in files
+            for group in groups]
+
+    # Jobs come back in order, so the output files are written in the same
+    # order whatever the number of workers
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers, initializer=_init_worker,
+                                    initargs=(tables, rules, args.seed))
+        results = pool.imap(_generate_job, jobs)
+    else:
+        pool = None
+        _init_worker(tables, rules, args.seed)
+        results = map(_generate_job, jobs)
+
+    restarts = []
+    orders = []
+    try:
+        for (filepath, group), (order, stats, error) in zip(jobs, results):
 
-            ### Step 3: Distribute the remaining items ###
+            filename = os.path.basename(filepath)
 
-            n = len(df)
-            max_depth = 500
+            if group == 1:
+                orders = []
+                print(f"\nPROCESSING FILE: {filename} (FILE NO "
+                      f"{files.index(filename)+1} / {len(files)})")
 
-            df_output = pseudorandomize(df,
-                                        df_output,
-                                        constraints,
-                                        n=n,
-                                        max_depth=max_depth)
-            df = df[~df["ItemNum"].isin(df_output["ItemNum"])]  # remove from df
+            if error is not None:
+                sys.exit(f"\n\033[31mCould not pseudorandomize order no "
+                         f"{group} of file {filename}: {error}\033[0m\n")
 
+            restarts.append(stats["restarts"])
+            orders.append(order)
             print("\n\033[1;38;5;22mFinished pseudorandomizing order no  "
-                  f"{current_group}.\033[0m")
-
-            # Save to CSV
-            file_exists = os.path.exists(out_filepath)  # check if file exists
-            df_output.to_csv(out_filepath, index=False, mode='a', header=not file_exists)
-
+                  f"{group}.\033[0m (restarts: {stats['restarts']}, "
+                  f"backtracks: {stats['backtracks']})")
+
+            # Save all orders of the file at once
+            if group == groups[-1]:
+                if args.compact:
+                    write_orders(orders, groups,
+                                 filepath.replace(".csv", "_orders.csv"))
+                else:
+                    build_orders(tables[filepath], orders, groups).to_csv(
+                        filepath.replace(".csv", "_pseudorandomized.csv"),
+                        index=False)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+    if restarts:
+        print(f"\nRestarts: {sum(restarts)} in {len(restarts)} orders "
+              f"({sum(restarts) / len(restarts):.2f} per order, "
+              f"{sum(r > 0 for r in restarts)} orders needed a restart).")
 
     print("\nAll files were successfully pseudorandomized.\n")
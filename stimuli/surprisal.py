@@ -5,13 +5,49 @@ import numpy as np
 import pandas as pd
 import re
 import math
-import transformers
-from transformers import AutoTokenizer, AutoModelForCausalLM
-import torch
-import torch.nn.functional as F
-from huggingface_hub import login
+import copy
+import gc
+import json
+import time
+import functools
+import importlib
+import importlib.util
+import urllib.error
+import urllib.request
+from surprisal_cache import SurprisalCache, model_cache_id
+from surprisal_backends import BACKENDS, convert_model, get_backend
+from surprisal_profiler import profiler
 
 
+# For reporting the time to the first scored sentences
+START_TIME = time.perf_counter()
+time_to_first_score = None
+
+
+class LazyModule:
+    """
+    Stand-in for a module that is only imported on first attribute access.
+    torch and transformers take seconds to import, which --help, usage
+    errors and runs answered entirely from the cache should not pay for.
+    """
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+
+torch = LazyModule('torch')
+mp = LazyModule('torch.multiprocessing')
+transformers = LazyModule('transformers')
+
+
+# Number of sequence positions sent through the LM head at once when
+# computing surprisal (caps the logits held in memory at
+# LOGIT_CHUNK_SIZE x vocabulary size)
+LOGIT_CHUNK_SIZE = 128
+
 
 def chunkstring(string, length):
     return (list(string[0+i:length+i] for i in range(0, len(string), length)))
@@ -20,50 +56,71 @@ def chunkstring(string, length):
 #    encoded_w = tokenizer.encode(word) # type: list
 #    return 1 if len(encoded_w)>2 else 0 # needs to be >2 because secret gpt2 will append </s> id to every encoding
 
-def get_surprisal(seq):
-    max_input_size = int(0.75*8000)
-    seq_chunks = chunkstring(seq.split(),max_input_size)
-    words, surprisals = [] , []
+def get_word_ids(encoding, words, pretokenized):
+    """
+    Map every token of an encoded chunk to the index of the
+    (whitespace-separated) word it belongs to, or -1 for special tokens.
+    Requires a fast tokenizer.
 
-    for seq in seq_chunks:
-        seq = ["<|endoftext|>"] + seq  # pre-pend a BOS token to avoid offset by one!
-        story_tokens, story_token_surprisal = [] , []
-        inputs = tokenizer(seq, is_split_into_words=True)
-        model_inputs = transformers.BatchEncoding({"input_ids":torch.tensor(inputs.input_ids).unsqueeze(0),
-            "attention_mask":torch.tensor(inputs.attention_mask).unsqueeze(0)})
+    Parameters:
+    encoding (BatchEncoding): the tokenizer output. For plain text input it
+                              must contain the offset_mapping and the
+                              special_tokens_mask.
+    words (list): the words of the chunk.
+    pretokenized (bool): whether the words were passed pre-split
+                         (is_split_into_words=True) behind a start token
+                         given as word 0 (GPT-2/Neo), in which case the
+                         tokenizer's word_ids() are used. Otherwise (Llama),
+                         the words were joined by single spaces and the
+                         character offsets of the tokens are mapped onto
+                         them: a token belongs to the first word ending after
+                         the token's start, so a token holding only the space
+                         in front of a word counts to that word.
 
-        with torch.no_grad():
-            outputs = model(**model_inputs)
+    Returns:
+    word_ids (array): one word index per token.
+    """
+    if pretokenized:
+        return np.array([-1 if w is None else w - 1 for w in encoding.word_ids()])
 
-        output_ids = model_inputs.input_ids.squeeze(0)[1:]
-        tokens = tokenizer.convert_ids_to_tokens(model_inputs.input_ids.squeeze(0))[1:]
-        index = torch.arange(0, output_ids.shape[0])
-        #surp = -1 * torch.log2(F.softmax(outputs.logits, dim = -1).squeeze(0)[index, output_ids])  # equivalent to below..
-        logits = outputs.logits.squeeze(0)
-        surp = -1 * torch.log2(F.softmax(logits, dim=-1)[index, output_ids])
+    word_ends = np.cumsum([len(w) + 1 for w in words]) - 1
+    token_starts = np.array([start for start, _ in encoding['offset_mapping']])
+    word_ids = np.searchsorted(word_ends, token_starts, side='right')
+    word_ids[np.array(encoding['special_tokens_mask'], dtype=bool)] = -1
+    return word_ids
 
-        story_tokens.extend(tokens)
-        story_token_surprisal.extend(np.array(surp))
 
-        # Word surprisal
-        i = 0
-        temp_token = ""
-        temp_surprisal = 0
+def aggregate_word_surprisal(token_surprisals, word_ids, n_words):
+    """
+    Sum token surprisals into word surprisals with a single segment sum
+    (index_add_ over the word index of every token). Tokens with word
+    index -1 are left out.
+    """
+    word_ids = torch.as_tensor(word_ids, dtype=torch.long)
+    keep = word_ids >= 0
+    return torch.zeros(n_words, dtype=torch.float64).index_add_(
+        0, word_ids[keep], token_surprisals[keep].double())
 
-        while i <= len(story_tokens)-1:
 
-            temp_token += story_tokens[i]
-            temp_surprisal += story_token_surprisal[i]
+def get_target_surprisal(words, surprisals, target_index=5):
+    """
+    Return the surprisal of the target word (word index target_index,
+    i.e. the 6th word by default), or None if the sentence is too short.
+    """
+    if target_index is not None and 0 <= target_index < len(surprisals):
+        target_surprisal = surprisals[target_index]
+        print(f'Target: {words[target_index]}, Surprisal: {str(round(target_surprisal, 4))}')
+    else:
+        target_surprisal = None
+    return target_surprisal
 
-            if i == len(story_tokens)-1 or tokens[i+1].startswith("Ġ"): # "_" # Unicode code point is not U+005F but U+2581
-                # remove start-of-token indicator
-                words.append(temp_token[1:])
-                surprisals.append(temp_surprisal)
-                # reset temp token/surprisal
-                temp_surprisal = 0
-                temp_token = ""
-            i += 1
 
+def format_surprisal(words, surprisals, target_index=5):
+    """
+    Turn word surprisals into the output columns: space-separated surprisals,
+    the surprisal of the target word (the 6th word by default) and
+    space-separated probabilities.
+    """
     # convert back surprisals into probs for later use
     probs = [1/(2**s) for s in surprisals]
 
@@ -71,11 +128,7 @@ def get_surprisal(seq):
     #print(words)
     #print(surprisals)
     #print(probs)
-    if len(surprisals) >= 6:
-        target_surprisal = surprisals[5]
-        print(f'Target: {words[5]}, Surprisal: {str(round(target_surprisal, 4))}')
-    else:
-        target_surprisal = None
+    target_surprisal = get_target_surprisal(words, surprisals, target_index)
 
     surprisals = " ".join(map(str, surprisals))
     probs = " ".join(map(str, probs))
@@ -83,133 +136,1315 @@ def get_surprisal(seq):
     return surprisals, target_surprisal, probs   # surprisals[-1]
 
 
-def get_surprisal_llama(seq):
-    max_input_size = int(0.75 * 8000)
-    seq_chunks = chunkstring(seq.split(), max_input_size)
-    words, surprisals = [], []
+def get_target_indices(df, target_pos=6, target_column=None):
+    """
+    Return the word index (0-based) of the target word in the FullSentence
+    of every row.
 
-    for seq in seq_chunks:
-        # Convert the list of words back into a single string
-        seq_str = " ".join(seq)
+    Parameters:
+    df (dataframe): the stimuli.
+    target_pos (int): word position (1-based) of the target in every
+                      sentence, used if no target_column is given.
+                      Default: 6 (the sixth word).
+    target_column (str): column giving the target of each row, either as
+                         1-based word position (e.g. TargetPos) or as the
+                         target word itself (e.g. TargetWord), which is
+                         matched against the words of the sentence
+                         (ignoring case and punctuation).
 
-        story_tokens, story_token_surprisal = [], []
-        inputs = tokenizer(seq_str)
+    Returns:
+    indices (list): the target word indices, None where there is no target.
+    """
+    if target_column is None:
+        return [target_pos - 1] * len(df)
 
-        # Ensure offset_mapping is handled safely
-        if 'offset_mapping' in inputs.keys():
-            offsets = inputs['offset_mapping']
+    indices = []
+    for sentence, target in zip(df['FullSentence'], df[target_column]):
+        if pd.isna(target):
+            indices.append(None)
+        elif isinstance(target, (int, float, np.integer, np.floating)):
+            indices.append(int(target) - 1)
         else:
-            offsets = None
+            words = [w.strip('.,;:!?"\'').lower() for w in sentence.split()]
+            target = str(target).strip().lower()
+            if target in words:
+                indices.append(words.index(target))
+            else:
+                print(f'Target word "{target}" not found in: {sentence}')
+                indices.append(None)
+    return indices
+
+
+def truncate_to_target(seq, target_index):
+    """
+    Cut a sequence after its target word, so that the forward pass never
+    runs over the continuation. Words are tokenized independently of their
+    right context, so the tokens of the cut sequence are exactly the tokens
+    up to the target's last subword in the full sequence.
+    """
+    if target_index is None:
+        return seq
+    return " ".join(seq.split()[:target_index + 1])
+
+
+def has_lm_head(model):
+    """
+    Whether the model is a transformer body plus a separate LM head.
+    """
+    return model.base_model is not model and model.get_output_embeddings() is not None
+
+
+def get_hidden_states(model, **model_inputs):
+    """
+    Run the model without its LM head. Returns the final hidden states and
+    the key/value cache (None unless use_cache=True is passed).
+    Models whose body cannot be separated from the head return their logits
+    instead, which get_token_surprisal accepts as well.
+    """
+    with profiler.stage('forward'):
+        if has_lm_head(model):
+            outputs = model.base_model(**model_inputs)
+            return outputs.last_hidden_state, outputs.past_key_values
+        outputs = model(**model_inputs)
+        return outputs.logits, outputs.past_key_values
+
+
+def get_token_surprisal(hidden, output_ids, model, chunk_size=None, predictions=None):
+    """
+    Surprisal in bits of each output_ids[i] given the final hidden state
+    hidden[i] of the preceding position.
+
+    The LM head is applied to chunk_size positions at a time and only the
+    log-probabilities of the observed tokens are kept
+    (logit[target] - logsumexp(logits)), so neither the full
+    [sequence, vocabulary] logits nor a softmax over them is ever
+    materialized.
 
-        model_inputs = transformers.BatchEncoding({
-            "input_ids": torch.tensor(inputs.input_ids).unsqueeze(0),
-            "attention_mask": torch.tensor(inputs.attention_mask).unsqueeze(0)
-        })
+    With predictions=k (an int >= 0), the same logits also give the entropy
+    (in bits) of every next-token distribution and its k most probable
+    tokens. The result is then a [positions, 2 + 2k] table with the columns
+    surprisal, entropy, k top token ids and their k log-probabilities
+    (natural log), see split_predictions.
+    """
+    if chunk_size is None:
+        chunk_size = LOGIT_CHUNK_SIZE
+    output_ids = torch.as_tensor(output_ids, dtype=torch.long)
+    apply_head = has_lm_head(model)
+    lm_head = model.get_output_embeddings()
+
+    if predictions is None:
+        surprisal = torch.empty(output_ids.shape[0], dtype=torch.float32)
+    else:
+        surprisal = torch.empty((output_ids.shape[0], 2 + 2 * predictions), dtype=torch.float32)
+    with profiler.stage('softmax_gather'):
+        for start in range(0, output_ids.shape[0], chunk_size):
+            logits = hidden[start:start + chunk_size]
+            if apply_head:
+                logits = lm_head(logits)
+            logits = logits.float()
+            log_norm = torch.logsumexp(logits, dim=-1)
+            target_logits = logits.gather(-1, output_ids[start:start + chunk_size].unsqueeze(-1)).squeeze(-1)
+            if predictions is None:
+                surprisal[start:start + chunk_size] = (log_norm - target_logits) / math.log(2)
+                continue
+            log_probs = logits - log_norm.unsqueeze(-1)
+            top_log_probs, top_ids = log_probs.topk(predictions, dim=-1)
+            rows = surprisal[start:start + chunk_size]
+            rows[:, 0] = (log_norm - target_logits) / math.log(2)
+            rows[:, 1] = -(log_probs.exp() * log_probs).sum(-1) / math.log(2)
+            # token ids are exact in float32 up to 2**24
+            rows[:, 2:2 + predictions] = top_ids.float()
+            rows[:, 2 + predictions:] = top_log_probs
+    return surprisal
+
+
+def split_predictions(table, word_ids, n_words):
+    """
+    Turn the [positions, 2 + 2k] table of get_token_surprisal(predictions=k)
+    into per-word values. Surprisals are summed over the tokens of a word;
+    entropy and top-k predictions are those of the position predicting the
+    first token of the word.
+
+    Returns:
+    surprisals (tensor): surprisal per word.
+    entropies (list): entropy per word.
+    top_k (list): per word, a list of the k (token id, log-prob) pairs.
+    """
+    k = (table.shape[1] - 2) // 2
+    word_ids = np.asarray(word_ids)
+    surprisals = aggregate_word_surprisal(table[:, 0], word_ids, n_words)
+    entropies = [None] * n_words
+    top_k = [[] for _ in range(n_words)]
+    words_present, first_positions = np.unique(word_ids, return_index=True)
+    for w, position in zip(words_present, first_positions):
+        if w < 0:
+            continue
+        row = table[position]
+        entropies[w] = float(row[1])
+        top_k[w] = list(zip(row[2:2 + k].long().tolist(), row[2 + k:].tolist()))
+    return surprisals, entropies, top_k
+
+
+def encode_sequence(seq, tokenizer, llama=False, max_input_size=int(0.75*8000)):
+    """
+    Tokenize a sequence in chunks of max_input_size words
+    (max_input_size=None tokenizes the whole sequence as one chunk).
+    GPT-2/Neo get the pre-split words behind a "<|endoftext|>" start token,
+    the Llama tokenizer gets the text and adds its own start token.
+
+    Returns a list with one (input ids, word ids, words) tuple per chunk,
+    see get_word_ids for the word ids.
+    """
+    words = seq.split()
+    if max_input_size is None:
+        max_input_size = max(len(words), 1)
+    encoded = []
+    with profiler.stage('tokenize'):
+        for chunk in chunkstring(words, max_input_size):
+            if llama:
+                inputs = tokenizer(" ".join(chunk), return_offsets_mapping=True, return_special_tokens_mask=True)
+            else:
+                # pre-pend a BOS token to avoid offset by one!
+                inputs = tokenizer(["<|endoftext|>"] + chunk, is_split_into_words=True)
+            encoded.append((inputs.input_ids, get_word_ids(inputs, chunk, pretokenized=not llama), chunk))
+    return encoded
+
+
+def pad_batch(batch_ids, pad_id, padding_side='right'):
+    """
+    Pad a list of input id lists to a common length on the tokenizer's
+    padding side. Position ids are derived from the attention mask so that
+    left-padded rows still start at position 0.
+    """
+    max_len = max(len(ids) for ids in batch_ids)
+    input_ids = torch.full((len(batch_ids), max_len), pad_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(batch_ids), max_len), dtype=torch.long)
+    offsets = []
+    for row, ids in enumerate(batch_ids):
+        offset = max_len - len(ids) if padding_side == 'left' else 0
+        input_ids[row, offset:offset + len(ids)] = torch.tensor(ids)
+        attention_mask[row, offset:offset + len(ids)] = 1
+        offsets.append(offset)
+    position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+    return input_ids, attention_mask, position_ids, offsets
+
+
+def get_token_surprisal_batched(all_ids, model, tokenizer, batch_size, predictions=None):
+    """
+    Compute token surprisals for many tokenized sequences with padded
+    forward passes. Sequences are sorted by length and cut into batches of
+    batch_size so that each batch holds sequences of similar length
+    (length bucketing keeps padding to a minimum).
+
+    Returns one surprisal tensor per sequence (for all tokens but the first),
+    in the original order (or prediction tables, see get_token_surprisal).
+    """
+    pad_id = tokenizer.pad_token_id
+    if pad_id is None:
+        pad_id = tokenizer.eos_token_id if tokenizer.eos_token_id is not None else 0
+
+    order = sorted(range(len(all_ids)), key=lambda i: len(all_ids[i]))
+    token_surprisals = [None] * len(all_ids)
+
+    for start in range(0, len(order), batch_size):
+        bucket = order[start:start + batch_size]
+        batch_ids = [all_ids[i] for i in bucket]
+        input_ids, attention_mask, position_ids, offsets = pad_batch(batch_ids, pad_id, tokenizer.padding_side)
 
         with torch.no_grad():
-            outputs = model(**model_inputs)
+            hidden, _ = get_hidden_states(model, input_ids=input_ids, attention_mask=attention_mask,
+                                          position_ids=position_ids)
 
-        output_ids = model_inputs.input_ids.squeeze(0)[1:]
-        logits = outputs.logits.squeeze(0)
-        index = torch.arange(0, output_ids.shape[0])
+            for row, i in enumerate(bucket):
+                n = len(batch_ids[row])
+                offset = offsets[row]
+                output_ids = input_ids[row, offset + 1:offset + n]
+                token_surprisals[i] = get_token_surprisal(hidden[row, offset:offset + n - 1], output_ids, model,
+                                                          predictions=predictions)
 
-        # Calculate token surprisals
-        surp = -1 * torch.log2(F.softmax(logits, dim=-1)[index, output_ids])
+    return token_surprisals
 
-        # Directly handle word-token mapping (no offsets in LLaMA tokenizer)
-        tokens = tokenizer.convert_ids_to_tokens(model_inputs.input_ids.squeeze(0).tolist())[1:]  # skip start token
-        token_surprisals = surp.tolist()
 
-        temp_token = ""
-        temp_surprisal = 0
+def get_max_positions(config):
+    """
+    Maximum number of positions the model can attend over
+    (max_position_embeddings, n_positions for GPT-2).
+    """
+    for attribute in ('max_position_embeddings', 'n_positions', 'n_ctx'):
+        value = getattr(config, attribute, None)
+        if value is not None:
+            return value
+    return None
 
-        for i, token in enumerate(tokens):
-            temp_token += token  # Build the word from subword tokens
-            temp_surprisal += token_surprisals[i]
 
-            # Check if this token is the last in the current word
-            if i == len(tokens) - 1 or tokens[i + 1].startswith('Ġ') or tokens[i + 1].startswith('▁'):
-                # Remove subword boundary markers and save the word
-                words.append(temp_token.lstrip("Ġ").lstrip("▁"))
-                surprisals.append(temp_surprisal)
-                temp_surprisal = 0
-                temp_token = ""
+def uses_rotary_positions(config):
+    """
+    Whether the model encodes positions with rotary embeddings (e.g. Llama),
+    where attention only depends on relative distances.
+    """
+    return any(getattr(config, attribute, None) is not None
+               for attribute in ('rope_theta', 'rope_parameters', 'rotary_dim'))
 
-    # Convert surprisals to probabilities
-    probs = [1 / (2 ** s) for s in surprisals]
 
-    # Print progress:
-    #print("Words:", words)
-    #print("Surprisals:", surprisals)
-    if len(surprisals) >= 6:
-        target_surprisal = surprisals[5]
-        print(f'Target: {words[5]}, Surprisal: {str(round(target_surprisal, 5))}')
+def drop_cache_positions(past, start, n):
+    """
+    Remove n cached positions, beginning at position start, from every layer
+    of a key/value cache.
+    """
+    def drop(tensor):
+        return torch.cat([tensor[..., :start, :], tensor[..., start + n:, :]], dim=-2)
+
+    if hasattr(past, 'layers'):
+        for layer in past.layers:
+            layer.keys = drop(layer.keys)
+            layer.values = drop(layer.values)
     else:
-        target_surprisal = None
+        for i in range(len(past.key_cache)):
+            past.key_cache[i] = drop(past.key_cache[i])
+            past.value_cache[i] = drop(past.value_cache[i])
 
-    surprisals = " ".join(map(str, surprisals))
-    probs = " ".join(map(str, probs))
 
-    return surprisals, target_surprisal, probs
+def get_token_surprisal_windowed(ids, model, window=None, stride=None, predictions=None):
+    """
+    Compute the token surprisals of one tokenized sequence that may be longer
+    than the model's context, with a sliding window of window tokens moved
+    forward by stride tokens. Every token is scored exactly once and the
+    start token is kept at the beginning of every window.
+
+    With rotary position embeddings (Llama), the key/value cache is carried
+    over between windows: before each step the oldest cached positions are
+    dropped so that at most window tokens are attended to, and nothing is
+    recomputed. The cached keys keep their positions, so this only works
+    while the text fits into the model's positions: from there on (and
+    always for models with absolute position embeddings, such as GPT-2 and
+    GPT-Neo), each window is recomputed with the start token at position 0,
+    so that no position beyond the model's maximum is ever used.
+
+    Parameters:
+    ids (list): input ids of the sequence, starting with the start token.
+    model: the causal language model.
+    window (int): number of tokens per window. Default: the model's maximum
+                  number of positions.
+    stride (int): number of new tokens scored per step. Default: window // 2.
+                  Smaller strides give the scored tokens more left context.
+    predictions (int): also return entropy and top-k predictions, see
+                       get_token_surprisal.
+
+    Returns:
+    surprisal (tensor): surprisal of all tokens but the first.
+    """
+    max_positions = get_max_positions(model.config)
+    if window is None:
+        window = max_positions
+    if max_positions is not None and window > max_positions:
+        raise ValueError(f"The window of {window} tokens exceeds the {max_positions} positions of the model.")
+    if stride is None:
+        stride = window // 2
+    if not 0 < stride < window:
+        raise ValueError(f"The stride must be between 1 and the window size - 1 ({window - 1}), got {stride}.")
+
+    ids = torch.as_tensor(ids, dtype=torch.long)
+    carry_cache = uses_rotary_positions(model.config)
 
+    with torch.no_grad():
+        first = ids[:window]
+        hidden, past = get_hidden_states(model, input_ids=first.unsqueeze(0), use_cache=carry_cache)
+        hidden = hidden.squeeze(0)
+        token_surprisals = [get_token_surprisal(hidden[:-1], first[1:], model, predictions=predictions)]
+        end = first.shape[0]
 
-def get_surprisal_file(model, chosen_model, filename):
-    df = pd.read_csv(filename, sep=',', encoding='utf-8')
-    if not 'llama' in chosen_model:
-        df[['Surprisals', 'TargetSurprisal', 'Probs']] = pd.DataFrame(df['FullSentence'].apply(get_surprisal).tolist(), index=df.index)
+        while end < ids.shape[0]:
+            new_end = min(end + stride, ids.shape[0])
+            block = ids[end:new_end]
+            last_hidden = hidden[-1]
+
+            if carry_cache and max_positions is not None and new_end > max_positions:
+                # Beyond the trained positions: recompute the windows from here on
+                carry_cache = False
+                past = None
+
+            if carry_cache:
+                # Keep the start token and the most recent tokens that fit into the window
+                excess = past.get_seq_length() + block.shape[0] - window
+                if excess > 0:
+                    drop_cache_positions(past, 1, excess)
+                cache_len = past.get_seq_length()
+                hidden, past = get_hidden_states(model, input_ids=block.unsqueeze(0),
+                                                 position_ids=torch.arange(end, new_end).unsqueeze(0),
+                                                 cache_position=torch.arange(cache_len, cache_len + block.shape[0]),
+                                                 past_key_values=past, use_cache=True)
+                hidden = hidden.squeeze(0)
+                prev_hidden = torch.cat([last_hidden.unsqueeze(0), hidden[:-1]])
+            else:
+                context = torch.cat([ids[:1], ids[max(1, new_end - window + 1):new_end]])
+                hidden, _ = get_hidden_states(model, input_ids=context.unsqueeze(0))
+                hidden = hidden.squeeze(0)
+                prev_hidden = hidden[-block.shape[0] - 1:-1]
+
+            token_surprisals.append(get_token_surprisal(prev_hidden, block, model, predictions=predictions))
+            end = new_end
+
+    return torch.cat(token_surprisals)
+
+
+def build_prefix_trie(all_ids):
+    """
+    Build a token trie over tokenized sequences. Every node is a dict with the
+    child nodes keyed by token id and the indices of the sequences ending in
+    this node.
+    """
+    root = {'children': {}, 'ends': []}
+    for i, ids in enumerate(all_ids):
+        node = root
+        for token in ids:
+            node = node['children'].setdefault(token, {'children': {}, 'ends': []})
+        node['ends'].append(i)
+    return root
+
+
+def get_token_surprisal_prefix_shared(all_ids, model, predictions=None):
+    """
+    Compute token surprisals for many tokenized sequences, running every
+    shared prefix through the model only once. The sequences are walked as a
+    trie: each unbranched run of tokens is one forward pass that continues
+    from the key/value cache of its parent, and the cache is rolled back to
+    the branching point before the next sibling is scored.
+
+    Returns one surprisal tensor per sequence (for all tokens but the first),
+    in the original order (or prediction tables, see get_token_surprisal).
+    """
+    token_surprisals = [None] * len(all_ids)
+
+    def visit(node, path_surprisals, last_hidden, past, past_len):
+        for token, child in node['children'].items():
+            # Collapse the unbranched chain below this edge into one segment
+            segment = [token]
+            while len(child['children']) == 1 and not child['ends']:
+                (token, child), = child['children'].items()
+                segment.append(token)
+
+            branch_past = past
+            if past is not None and not hasattr(past, 'crop'):
+                branch_past = copy.deepcopy(past)  # caches that cannot be rolled back are copied per branch
+
+            with torch.no_grad():
+                hidden, branch_past = get_hidden_states(model, input_ids=torch.tensor([segment]),
+                                                        past_key_values=branch_past, use_cache=True)
+                hidden = hidden.squeeze(0)
+
+                # The first token of a segment is predicted by the last position of the parent
+                if last_hidden is None:
+                    prev_hidden, output_ids = hidden[:-1], segment[1:]
+                else:
+                    prev_hidden, output_ids = torch.cat([last_hidden.unsqueeze(0), hidden[:-1]]), segment
+                surp = get_token_surprisal(prev_hidden, output_ids, model, predictions=predictions)
+
+            child_surprisals = path_surprisals + [surp]
+            for i in child['ends']:
+                token_surprisals[i] = torch.cat(child_surprisals)
+
+            visit(child, child_surprisals, hidden[-1], branch_past, past_len + len(segment))
+
+            if past is not None and hasattr(past, 'crop'):
+                past.crop(past_len)  # drop this branch from the shared cache
+
+    visit(build_prefix_trie(all_ids), [], None, None, 0)
+    return token_surprisals
+
+
+def get_word_surprisal_many(seqs, model, tokenizer, llama=False, batch_size=1, share_prefix=False,
+                            sliding_window=False, window=None, stride=None, entropy=False, top_k=0):
+    """
+    Score a list of sequences at once and return a (words, surprisals) tuple
+    for each sequence. The forward passes are either run in padded,
+    length-bucketed batches of batch_size, or (share_prefix=True) once per
+    shared prefix, reusing its key/value cache for all continuations.
+    With sliding_window=True, sequences are not cut into word chunks but
+    scored as a whole with get_token_surprisal_windowed (window, stride),
+    so that long texts keep their left context.
+    With entropy=True or top_k > 0, the tuples are
+    (words, surprisals, entropies, top_k predictions) instead, computed from
+    the same logits (see split_predictions).
+    """
+    # Flatten all word chunks of all sequences into one list to be scored
+    chunks, owners = [], []
+    for s, seq in enumerate(seqs):
+        for chunk in encode_sequence(seq, tokenizer, llama, max_input_size=None if sliding_window else int(0.75*8000)):
+            chunks.append(chunk)
+            owners.append(s)
+    all_ids = [ids for ids, _, _ in chunks]
+    predictions = top_k if entropy or top_k else None
+    if profiler.enabled:
+        sentence_tokens = np.bincount(owners, weights=[len(ids) for ids in all_ids], minlength=len(seqs))
+        for seq, n_tokens in zip(seqs, sentence_tokens.astype(int).tolist()):
+            profiler.observe('tokens_per_sentence', n_tokens, words=len(seq.split()))
+        profiler.count('sentences', len(seqs))
+        profiler.count('tokens', int(sentence_tokens.sum()))
+
+    if sliding_window:
+        token_surprisals = [get_token_surprisal_windowed(ids, model, window=window, stride=stride,
+                                                         predictions=predictions)
+                            for ids in all_ids]
+    elif share_prefix:
+        token_surprisals = get_token_surprisal_prefix_shared(all_ids, model, predictions=predictions)
+    else:
+        token_surprisals = get_token_surprisal_batched(all_ids, model, tokenizer, batch_size,
+                                                       predictions=predictions)
+
+    words = [[] for _ in seqs]
+    surprisals = [[] for _ in seqs]
+    entropies = [[] for _ in seqs]
+    top_predictions = [[] for _ in seqs]
+    with profiler.stage('aggregate'):
+        for (_, word_ids, chunk_words), surp, s in zip(chunks, token_surprisals, owners):
+            # the first token (the start token) has no surprisal
+            if predictions is None:
+                chunk_surprisals = aggregate_word_surprisal(surp, word_ids[1:], len(chunk_words))
+            else:
+                chunk_surprisals, chunk_entropies, chunk_top_k = split_predictions(surp, word_ids[1:],
+                                                                                   len(chunk_words))
+                entropies[s].extend(chunk_entropies)
+                top_predictions[s].extend(chunk_top_k)
+            words[s].extend(chunk_words)
+            surprisals[s].extend(chunk_surprisals.tolist())
+
+    if predictions is None:
+        return list(zip(words, surprisals))
+    return list(zip(words, surprisals, entropies, top_predictions))
+
+
+def starts_new_word(token_id, tokenizer):
+    """
+    Whether a token cannot continue the preceding word: it begins with
+    whitespace or is a special token (words are whitespace-separated, as in
+    seq.split()).
+    """
+    if token_id in tokenizer.all_special_ids:
+        return True
+    text = tokenizer.decode([token_id])
+    return not text or text[0].isspace()
+
+
+def complete_words(context_ids, candidates, model, tokenizer, max_tokens=8):
+    """
+    Complete predicted first tokens into whole words by greedy decoding: each
+    candidate is extended with the most probable next token until that token
+    would start a new word (or after max_tokens tokens). The context is run
+    once and its key/value cache shared by all candidates; backends without
+    a key/value cache (onnx) run the context and the tokens decoded so far
+    again at every step.
+
+    Parameters:
+    context_ids (list): input ids up to the predicted word, start token
+                        included.
+    candidates (list): (token id, log-prob) pairs of the predicted first
+                       tokens, e.g. the top-k of split_predictions.
+
+    Returns:
+    completions (list): (word, probability) per candidate; the probability is
+                        that of the first token times those of its greedy
+                        continuation.
+    """
+    max_positions = get_max_positions(model.config)
+    if max_positions is not None and len(context_ids) + max_tokens > max_positions:
+        # keep the start token and the most recent context
+        context_ids = context_ids[:1] + context_ids[len(context_ids) - max_positions + max_tokens + 1:]
+
+    tokens = [[token_id] for token_id, _ in candidates]
+    log_probs = [log_prob for _, log_prob in candidates]
+    done = [token_id in tokenizer.all_special_ids for token_id, _ in candidates]
+
+    use_cache = get_backend(model) != 'onnx'
+
+    with torch.no_grad():
+        next_ids = torch.tensor([[token_id] for token_id, _ in candidates])
+        if use_cache:
+            _, past = get_hidden_states(model, input_ids=torch.tensor([context_ids]), use_cache=True)
+            if hasattr(past, 'batch_repeat_interleave'):
+                past.batch_repeat_interleave(len(candidates))
+            else:
+                _, past = get_hidden_states(model, input_ids=torch.tensor([context_ids] * len(candidates)),
+                                            use_cache=True)
+        else:
+            # every candidate is extended by one token per step, so all sequences keep the same length
+            sequences = torch.cat([torch.tensor([context_ids] * len(candidates)), next_ids], dim=1)
+        for step in range(max_tokens):
+            if all(done):
+                break
+            if use_cache:
+                hidden, past = get_hidden_states(model, input_ids=next_ids, past_key_values=past, use_cache=True)
+            else:
+                hidden, _ = get_hidden_states(model, input_ids=sequences)
+            logits = hidden[:, -1]
+            if has_lm_head(model):
+                logits = model.get_output_embeddings()(logits)
+            step_log_probs = torch.log_softmax(logits.float(), dim=-1)
+            best = step_log_probs.argmax(-1)
+            for i, token_id in enumerate(best.tolist()):
+                if done[i]:
+                    continue
+                if starts_new_word(token_id, tokenizer):
+                    done[i] = True
+                else:
+                    tokens[i].append(token_id)
+                    log_probs[i] += float(step_log_probs[i, token_id])
+            next_ids = best.unsqueeze(-1)
+            if not use_cache:
+                sequences = torch.cat([sequences, next_ids], dim=1)
+
+    return [(tokenizer.decode(t).strip(), math.exp(log_prob)) for t, log_prob in zip(tokens, log_probs)]
+
+
+def get_target_predictions(text, scored, target_index, model, tokenizer, llama=False, complete=True):
+    """
+    The top-k predicted words at the position of the target word of a text,
+    as a list of (word, probability) pairs (empty if the text has no word at
+    target_index).
+
+    Parameters:
+    text (str): the scored text.
+    scored (tuple): its (words, surprisals, entropies, top_k) result of
+                    get_word_surprisal_many.
+    complete (bool): complete predicted word beginnings into whole words
+                     (see complete_words) instead of returning the predicted
+                     first tokens.
+    """
+    words, _, _, top_k = scored
+    if target_index is None or not 0 <= target_index < len(words):
+        return []
+    candidates = top_k[target_index]
+    if complete:
+        context = " ".join(text.split()[:target_index])
+        encoded = encode_sequence(context, tokenizer, llama, max_input_size=None)
+        # a target at the start of the text only has the start token as context
+        context_ids = encoded[0][0] if encoded else [tokenizer.bos_token_id]
+        predictions = complete_words(context_ids, candidates, model, tokenizer)
     else:
-        df[['Surprisals', 'TargetSurprisal', 'Probs']] = pd.DataFrame(df['FullSentence'].apply(get_surprisal_llama).tolist(), index=df.index)
+        predictions = [(tokenizer.decode([token_id]).strip(), math.exp(log_prob))
+                       for token_id, log_prob in candidates]
+    # keep the columns space-separated for tokens that are only whitespace
+    return [(word or tokenizer.convert_ids_to_tokens(token_id), prob)
+            for (word, prob), (token_id, _) in zip(predictions, candidates)]
+
+
+def _init_worker(worker_model, worker_tokenizer, n_threads):
+    """
+    Set up a scoring worker: keep the (shared) model and tokenizer as the
+    worker's global model and tokenizer and limit its torch threads.
+    """
+    global model, tokenizer
+    model, tokenizer = worker_model, worker_tokenizer
+    torch.set_num_threads(n_threads)
+
+
+def _score_shard(shard):
+    seqs, llama, kwargs = shard
+    return get_word_surprisal_many(seqs, model, tokenizer, llama=llama, **kwargs)
+
+
+def get_word_surprisal_parallel(seqs, model, tokenizer, llama=False, workers=2,
+                                threads_per_worker=None, **kwargs):
+    """
+    Data-parallel version of get_word_surprisal_many for CPU hosts: the
+    sequences are cut into contiguous shards (keeping the conditions of an
+    item together for prefix sharing) that are scored by a pool of worker
+    processes. Results are returned in the original order.
+
+    The workers do not get their own copy of the weights. On Linux they are
+    forked from this process and map the parent's (read-only) weight pages
+    copy-on-write; where fork is unavailable, the weights are first moved to
+    shared memory and the workers map that.
+
+    Parameters:
+    workers (int): number of worker processes.
+    threads_per_worker (int): torch threads per worker. Default: the number
+                              of cores divided by the number of workers.
+    kwargs: scoring options passed on to get_word_surprisal_many.
+    """
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+
+    n_shards = min(len(seqs), workers * 4)
+    bounds = np.linspace(0, len(seqs), n_shards + 1).astype(int)
+    shards = [(seqs[start:end], llama, kwargs) for start, end in zip(bounds[:-1], bounds[1:])]
+
+    start_method = 'fork' if 'fork' in mp.get_all_start_methods() else 'spawn'
+    if start_method == 'spawn':
+        model.share_memory()
+    # the tokenizers library must not use its own threads in forked workers
+    os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+
+    with mp.get_context(start_method).Pool(workers, initializer=_init_worker,
+                                           initargs=(model, tokenizer, threads_per_worker)) as pool:
+        results = pool.map(_score_shard, shards)
+
+    return [result for shard in results for result in shard]
+
+
+def get_surprisal_many(seqs, model, tokenizer, llama=False, **kwargs):
+    """
+    Score a list of sequences at once and return the same
+    (surprisals, target surprisal, probs) tuple for each sequence as
+    get_surprisal / get_surprisal_llama. Keyword arguments are passed on to
+    get_word_surprisal_many.
+    """
+    results = get_word_surprisal_many(seqs, model, tokenizer, llama=llama, **kwargs)
+    return [format_surprisal(w, s) for w, s in results]
+
+
+def get_surprisal(seq, llama=False):
+    """
+    Score one sequence with the global model and tokenizer and return its
+    (surprisals, target surprisal, probs) tuple.
+    """
+    return get_surprisal_many([seq], model, tokenizer, llama=llama)[0]
+
+
+def get_surprisal_llama(seq):
+    return get_surprisal(seq, llama=True)
+
+
+def get_word_surprisal_remote(seqs, server, chosen_model):
+    """
+    Score sequences on a running surprisal_server.py instead of a local
+    model and return the same (words, surprisals) tuples as
+    get_word_surprisal_many. The scoring options (batch size, prefix
+    sharing) are those the server was started with.
+
+    Parameters:
+    seqs (list): the sequences to score.
+    server (str): address of the server, e.g. 'http://127.0.0.1:8765'.
+    chosen_model (str): one of the models loaded by the server.
+    """
+    request = urllib.request.Request(
+        server.rstrip('/') + '/score',
+        data=json.dumps({'model': chosen_model, 'sentences': seqs}).encode('utf-8'),
+        headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request) as response:
+            results = json.load(response)['results']
+    except urllib.error.HTTPError as e:
+        sys.exit(f"Surprisal server error: {json.load(e).get('error', e.reason)}")
+    except urllib.error.URLError as e:
+        sys.exit(f"Could not reach the surprisal server at {server}: {e.reason}")
+    return [(r['words'], r['surprisals']) for r in results]
+
+
+def get_peak_rss_mb():
+    """
+    Peak resident memory of this process so far in MB (None where the
+    resource module is unavailable, i.e. on Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+
+@functools.cache
+def login_llama():
+    try:
+        with open("access_token.txt", "r") as file:
+            access_token = file.read().strip()
+    except:
+        print("Could not read Llama access token. Check that 'access_token.txt' is present in the working directory.")
+        sys.exit(1)
+    from huggingface_hub import login
+    login(token = access_token)
+
+
+def get_model_name(chosen_model):
+    """
+    Hugging Face name of one of the possible models (gpt2-large, gpt-neo or
+    llama). For llama, this logs in with the token in access_token.txt.
+    """
+    if "neo" in chosen_model:
+        return 'EleutherAI/gpt-neo-2.7B'
+    elif "llama" in chosen_model:
+        login_llama()
+        return "meta-llama/Meta-Llama-3-8B"
+    else:
+        return 'openai-community/gpt2-large'
+
+
+def load_tokenizer(chosen_model):
+    model_name = get_model_name(chosen_model)
+    if "llama" in chosen_model:
+        return transformers.AutoTokenizer.from_pretrained(model_name, padding_side='left')
+    return transformers.AutoTokenizer.from_pretrained(model_name, add_prefix_space=True)
+
+
+def load_weights(chosen_model, backend='torch', onnx_dir='onnx_models'):
+    """
+    Load the model for one of the possible models and convert it to the
+    given inference backend (torch, torch-int8 or onnx; see
+    surprisal_backends.py). Exported ONNX graphs are kept in onnx_dir and
+    reused. Prints the loading time and the peak memory use.
+    """
+    print('Loading model: ' + chosen_model + '...')
+    start = time.perf_counter()
+
+    # safetensors checkpoints (preferred when available) are memory-mapped,
+    # and low_cpu_mem_usage fills the model with the mapped weights directly
+    # instead of first allocating a randomly initialized copy
+    model = transformers.AutoModelForCausalLM.from_pretrained(get_model_name(chosen_model),
+                                                              low_cpu_mem_usage=True)
+    model.eval()
+
+    if backend != 'torch':
+        print(f'Converting model to backend: {backend}...')
+        model = convert_model(model, backend, onnx_path=os.path.join(onnx_dir, f'{chosen_model}.onnx'))
+
+    peak_rss = get_peak_rss_mb()
+    print(f'Loaded {chosen_model} in {time.perf_counter() - start:.1f} s'
+          + (f' (peak RSS: {peak_rss:.0f} MB)' if peak_rss is not None else ''))
+    return model
+
+
+def load_model(chosen_model, backend='torch', onnx_dir='onnx_models'):
+    """
+    Load the model and tokenizer for one of the possible models
+    (gpt2-large, gpt-neo or llama), see load_weights.
+    """
+    tokenizer = load_tokenizer(chosen_model)
+    return load_weights(chosen_model, backend=backend, onnx_dir=onnx_dir), tokenizer
+
+
+class DeferredModel:
+    """
+    Placeholder for a model whose weights are only loaded (see load_weights)
+    once a sentence actually has to be scored, so that runs answered
+    entirely from the cache never load them. Only the model config is read
+    up front, for the cache key.
+    """
+
+    def __init__(self, chosen_model, backend='torch', onnx_dir='onnx_models'):
+        self.chosen_model = chosen_model
+        self.backend = backend
+        self.onnx_dir = onnx_dir
+        self.config = transformers.AutoConfig.from_pretrained(get_model_name(chosen_model))
+        self.model = None
+
+    def load(self):
+        if self.model is None:
+            self.model = load_weights(self.chosen_model, backend=self.backend, onnx_dir=self.onnx_dir)
+        return self.model
+
+
+def get_fidelity_report(reference, scored, target_indices=None):
+    """
+    Compare the word surprisals of a backend against the fp32 reference.
+
+    Parameters:
+    reference (list): (words, surprisals) tuples scored with the fp32 model.
+    scored (list): (words, surprisals) tuples of the same texts scored with
+                   the backend.
+    target_indices (list): optional target word index per text, to also
+                           compare the target surprisals.
+
+    Returns:
+    report (dict): number of words and the maximum and mean absolute
+                   surprisal difference (in bits), over all words and over
+                   the target words.
+    """
+    differences = [np.abs(np.subtract(s, r)) for (_, r), (_, s) in zip(reference, scored)]
+    all_differences = np.concatenate(differences) if differences else np.array([])
+    report = {'n_sentences': len(differences),
+              'n_words': int(all_differences.size),
+              'max_abs_diff': float(all_differences.max()) if all_differences.size else None,
+              'mean_abs_diff': float(all_differences.mean()) if all_differences.size else None}
+    if target_indices is not None:
+        target_differences = np.array([d[t] for d, t in zip(differences, target_indices)
+                                       if t is not None and 0 <= t < len(d)])
+        report['max_abs_diff_target'] = float(target_differences.max()) if target_differences.size else None
+        report['mean_abs_diff_target'] = float(target_differences.mean()) if target_differences.size else None
+    return report
+
+
+def get_surprisal_df(df, model, tokenizer, chosen_model, cache=None, refresh=False,
+                     target_pos=6, target_column=None, target_only=False,
+                     workers=1, threads_per_worker=None, fidelity_report=False, server=None,
+                     entropy=False, top_k=0, complete=True, as_lists=False, **kwargs):
+    """
+    Compute the Surprisals, TargetSurprisal and Probs columns for the
+    FullSentence of every row of a stimulus dataframe and return them as a
+    new dataframe with the same index.
+    The target word is the word at position target_pos or given per row in
+    target_column (see get_target_indices). With target_only=True, each
+    sentence is only run through the model up to its target word and only
+    the TargetSurprisal column is returned.
+    With entropy=True, the Entropies (entropy in bits of the next-token
+    distribution before every word) and TargetEntropy columns are added;
+    with top_k > 0, the TopKWords and TopKProbs columns with the k most
+    probable words at the target position. Both come from the logits of the
+    scoring pass; with complete=True, predicted word beginnings are completed
+    into whole words (see complete_words). These runs do not read the cache.
+    With as_lists=True, the per-word columns hold lists (of floats, or of
+    strings for the Words column that is added) instead of space-separated
+    strings, for typed columnar output (see to_arrow_table).
+    Every distinct sentence is scored once, with the scoring options in
+    kwargs (batch_size, share_prefix, sliding_window, window, stride; see
+    get_word_surprisal_many). If a SurprisalCache is given, sentences scored
+    in earlier runs are read from it and only new or edited sentences are
+    sent through the model (refresh=True rescores everything and overwrites
+    the cached values). If model is a DeferredModel, its weights are only
+    loaded when some sentence is not in the cache. With workers > 1, the
+    sentences to score are sharded across worker processes (see
+    get_word_surprisal_parallel).
+    If the model runs on a backend other than fp32 torch and
+    fidelity_report=True, all sentences are also scored with the fp32 model
+    and the differences are printed (see get_fidelity_report).
+    With a server address, the sentences are scored by a running
+    surprisal_server.py (see get_word_surprisal_remote) and model and
+    tokenizer are not used.
+    """
+    llama = 'llama' in chosen_model
+    sentences = df['FullSentence'].tolist()
+    unique_sentences = list(dict.fromkeys(sentences))
+    target_indices = get_target_indices(df, target_pos=target_pos, target_column=target_column)
+
+    # In target-only mode, each sentence is only scored up to its target word
+    if target_only:
+        texts = [truncate_to_target(s, t) for s, t in zip(sentences, target_indices)]
+    else:
+        texts = sentences
+
+    word_surprisals = {}
+    if cache is not None:
+        # the sliding window changes the context of long texts, and the backend
+        # the precision of all values, so both are part of the key
+        scoring = {}
+        if kwargs.get('sliding_window'):
+            scoring = {'window': kwargs.get('window'), 'stride': kwargs.get('stride')}
+        if get_backend(model) != 'torch':
+            scoring['backend'] = get_backend(model)
+        model_id = model_cache_id(model, tokenizer, **scoring)
+        # the cache only holds surprisals, entropies and predictions need the logits
+        if not refresh and not (entropy or top_k):
+            with profiler.stage('cache_read'):
+                word_surprisals = cache.get_many(model_id, unique_sentences)
+        print(f'Found {len(word_surprisals)} of {len(unique_sentences)} sentences in the cache.')
+
+    # Full sentences found in the cache also cover their truncated texts
+    texts = [s if s in word_surprisals else t for s, t in zip(sentences, texts)]
+    to_score = [t for t in dict.fromkeys(texts) if t not in word_surprisals]
+    if to_score:
+        if isinstance(model, DeferredModel):
+            model = model.load()
+        if server is not None:
+            results = get_word_surprisal_remote(to_score, server, chosen_model)
+        elif workers > 1:
+            results = get_word_surprisal_parallel(to_score, model, tokenizer, llama=llama, workers=workers,
+                                                  threads_per_worker=threads_per_worker,
+                                                  entropy=entropy, top_k=top_k, **kwargs)
+        else:
+            results = get_word_surprisal_many(to_score, model, tokenizer, llama=llama,
+                                              entropy=entropy, top_k=top_k, **kwargs)
+        scored = dict(zip(to_score, results))
+        if cache is not None and not target_only:
+            with profiler.stage('cache_write'):
+                cache.put_many(model_id, {t: result[:2] for t, result in scored.items()})
+        word_surprisals.update(scored)
+
+    if fidelity_report and get_backend(model) != 'torch':
+        unique_texts = list(dict.fromkeys(texts))
+        reference_model, _ = load_model(chosen_model)
+        reference = get_word_surprisal_many(unique_texts, reference_model, tokenizer, llama=llama, **kwargs)
+        del reference_model
+        gc.collect()
+        text_targets = dict(zip(texts, target_indices))
+        report = get_fidelity_report(reference, [word_surprisals[t][:2] for t in unique_texts],
+                                     [text_targets[t] for t in unique_texts])
+        print(f'\nFidelity of the {get_backend(model)} backend against fp32 ({chosen_model}):')
+        for key, value in report.items():
+            print(f'  {key}: {value}')
+
+    global time_to_first_score
+    if time_to_first_score is None:
+        time_to_first_score = time.perf_counter() - START_TIME
+        print(f'Time to first score: {time_to_first_score:.1f} s')
+
+    if as_lists:
+        join = list
+    else:
+        join = lambda values: " ".join(map(str, values))
+
+    if target_only:
+        scores = pd.DataFrame({'TargetSurprisal': [get_target_surprisal(*word_surprisals[t][:2], target_index)
+                                                   for t, target_index in zip(texts, target_indices)]},
+                              index=df.index)
+    elif as_lists:
+        scores = pd.DataFrame({'Words': [list(word_surprisals[t][0]) for t in texts],
+                               'Surprisals': [list(word_surprisals[t][1]) for t in texts],
+                               'TargetSurprisal': [get_target_surprisal(*word_surprisals[t][:2], target_index)
+                                                   for t, target_index in zip(texts, target_indices)],
+                               'Probs': [[1/(2**s) for s in word_surprisals[t][1]] for t in texts]},
+                              index=df.index)
+    else:
+        results = [format_surprisal(*word_surprisals[t][:2], target_index)
+                   for t, target_index in zip(texts, target_indices)]
+        scores = pd.DataFrame(results, index=df.index, columns=['Surprisals', 'TargetSurprisal', 'Probs'])
+
+    if entropy:
+        if not target_only:
+            scores['Entropies'] = [join(word_surprisals[t][2]) for t in texts]
+        target_entropies = []
+        for t, i in zip(texts, target_indices):
+            entropies = word_surprisals[t][2]
+            target_entropies.append(entropies[i] if i is not None and 0 <= i < len(entropies) else None)
+        scores['TargetEntropy'] = target_entropies
+    if top_k:
+        target_predictions = {}
+        for t, i in dict.fromkeys(zip(texts, target_indices)):
+            target_predictions[t, i] = get_target_predictions(t, word_surprisals[t], i, model, tokenizer,
+                                                              llama=llama, complete=complete)
+        scores['TopKWords'] = [join([w for w, _ in target_predictions[key]]) for key in zip(texts, target_indices)]
+        scores['TopKProbs'] = [join([p for _, p in target_predictions[key]]) for key in zip(texts, target_indices)]
+    return scores
+
+
+def get_output_filename(filename, chosen_models, output_format='csv'):
+    return f"{os.path.splitext(filename)[0]}_surprisal_{'_'.join(chosen_models)}.{output_format}"
+
+
+# Types of the score columns in columnar output (see to_arrow_table)
+LIST_COLUMNS = {'Words': 'string', 'Surprisals': 'float', 'Probs': 'float', 'Entropies': 'float',
+                'TopKWords': 'string', 'TopKProbs': 'float'}
+FLOAT_COLUMNS = ['TargetSurprisal', 'TargetEntropy']
+
+
+def to_arrow_table(df, float32=False):
+    """
+    Convert a scored dataframe (get_surprisal_df with as_lists=True) to an
+    Arrow table with typed columns: the per-word columns become list<float>
+    or list<string> columns and the target columns floats, in single
+    precision with float32=True. The other columns keep their inferred
+    types.
+    """
+    import pyarrow as pa
+
+    float_type = pa.float32() if float32 else pa.float64()
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for i, name in enumerate(table.column_names):
+        if name in LIST_COLUMNS:
+            column_type = pa.list_(pa.string() if LIST_COLUMNS[name] == 'string' else float_type)
+        elif name in FLOAT_COLUMNS:
+            column_type = float_type
+        else:
+            continue
+        table = table.set_column(i, name, table.column(name).cast(column_type))
+    return table
+
+
+def get_surprisal_file(model, tokenizer, chosen_model, filename, output_format='csv', float32=False, **kwargs):
+    """
+    Add the Surprisals, TargetSurprisal and Probs columns to a stimulus file
+    and write it to <filename>_surprisal_<model>.csv. Keyword arguments are
+    passed on to get_surprisal_df.
+    With output_format='parquet', the file is written as
+    <filename>_surprisal_<model>.parquet instead, with typed list columns
+    for the per-word values (see to_arrow_table).
+    """
+    with profiler.stage('csv_read'):
+        df = pd.read_csv(filename, sep=',', encoding='utf-8')
+    scores = get_surprisal_df(df, model, tokenizer, chosen_model, as_lists=output_format == 'parquet', **kwargs)
+    df[scores.columns] = scores
     #df['surprisal'] = df['FullSentence'].apply(get_surprisal)
     #df['BPE_split'] = df['FullSentence'].apply(BPE_split)
-    out_filename = f'{filename.rstrip('.csv')}_surprisal_{chosen_model}.csv'
+    out_filename = get_output_filename(filename, [chosen_model], output_format)
     print(f'\nWriting to file: {out_filename}')
-    df.to_csv(out_filename,
-              sep = ',', encoding = 'utf-8', index = False)
+    with profiler.stage('write'):
+        if output_format == 'parquet':
+            import pyarrow.parquet as pq
+            pq.write_table(to_arrow_table(df, float32), out_filename)
+        else:
+            df.to_csv(out_filename,
+                      sep = ',', encoding = 'utf-8', index = False)
     return df
 
 
-if __name__=='__main__':
+def get_surprisal_file_stream(model, tokenizer, chosen_model, filename, chunk_rows=1000,
+                              resume=False, **kwargs):
+    """
+    Streaming version of get_surprisal_file for large inputs: the stimulus
+    file is read in chunks of chunk_rows rows, and each chunk is appended to
+    the output file as soon as it is scored, so memory use does not grow with
+    the size of the file.
 
-    if len(sys.argv) != 3:
-        print(f"\nUSAGE:   {sys.argv[0]} <model> <stimmuli file>")
-        print(f"EXAMPLE: {sys.argv[0]} gpt2-large stimuli.csv\n")
-        sys.exit(1)
+    After every chunk, a checkpoint file (<output file>.checkpoint) records
+    the number of rows done and the size of the output file. With
+    resume=True, an interrupted run continues after the last completed chunk
+    (any partially written chunk is cut off the output first). The
+    checkpoint is removed once the whole file is done, so resuming an
+    output file without a checkpoint keeps it and scores nothing.
+    Keyword arguments are passed on to get_surprisal_df.
+    """
+    out_filename = get_output_filename(filename, [chosen_model])
+    checkpoint_filename = out_filename + '.checkpoint'
+
+    rows_done = 0
+    if resume and os.path.isfile(checkpoint_filename):
+        with open(checkpoint_filename, 'r') as file:
+            checkpoint = json.load(file)
+        if checkpoint['input'] != os.path.abspath(filename) or checkpoint['model'] != chosen_model:
+            sys.exit(f"The checkpoint {checkpoint_filename} belongs to a different input file or model.")
+        if not os.path.isfile(out_filename) or os.path.getsize(out_filename) < checkpoint['output_bytes']:
+            sys.exit(f"The output file {out_filename} is missing or shorter than recorded in the checkpoint "
+                     f"{checkpoint_filename}; remove the checkpoint to score the file from the start.")
+        rows_done = checkpoint['rows_done']
+        # drop anything written after the last checkpoint
+        with open(out_filename, 'r+b') as file:
+            file.truncate(checkpoint['output_bytes'])
+        print(f'Resuming after row {rows_done}.')
+    elif resume and os.path.exists(out_filename):
+        # the checkpoint is removed once a run is complete
+        print(f'Nothing to resume: {out_filename} has no checkpoint and is kept as it is.')
+        return
+    elif os.path.exists(out_filename):
+        os.remove(out_filename)
+
+    reader = pd.read_csv(filename, sep=',', encoding='utf-8', chunksize=chunk_rows,
+                         skiprows=range(1, rows_done + 1))
+    while True:
+        with profiler.stage('csv_read'):
+            df = next(reader, None)
+        if df is None:
+            break
+        scores = get_surprisal_df(df, model, tokenizer, chosen_model, **kwargs)
+        df[scores.columns] = scores
+
+        with profiler.stage('write'), open(out_filename, 'a', encoding='utf-8', newline='') as file:
+            df.to_csv(file, sep=',', index=False, header=rows_done == 0)
+            file.flush()
+            os.fsync(file.fileno())
+        rows_done += len(df)
+
+        # write the checkpoint atomically
+        with open(checkpoint_filename + '.tmp', 'w') as file:
+            json.dump({'input': os.path.abspath(filename), 'model': chosen_model,
+                       'rows_done': rows_done, 'output_bytes': os.path.getsize(out_filename)}, file)
+        os.replace(checkpoint_filename + '.tmp', checkpoint_filename)
+        print(f'Wrote {rows_done} rows to file: {out_filename}')
+
+    if os.path.exists(checkpoint_filename):
+        os.remove(checkpoint_filename)
 
-    chosen_model = sys.argv[1].lower()
-    filename = sys.argv[2]
+
+def get_surprisal_file_models(chosen_models, filename, backend='torch', onnx_dir='onnx_models',
+                              server=None, output_format='csv', float32=False, **kwargs):
+    """
+    Score a stimulus file with several models in one run and write a single
+    wide file <filename>_surprisal_<model1>_<model2>....csv with one group of
+    columns per model (e.g. TargetSurprisal_gpt2_large).
+    The file is read and written once. The models are loaded one after the
+    other and each model is freed before the next one is loaded, so peak
+    memory stays bounded by the largest single model. All models run on the
+    given backend (see load_weights); a model whose sentences are all in the
+    cache is not loaded at all. With a server address, no model is loaded
+    and all models are scored by the server. Keyword arguments are
+    passed on to get_surprisal_df.
+    With output_format='parquet', the models are not put side by side but
+    stacked: every model is appended to the .parquet file as one row group
+    of the input rows with its scores (typed list columns, see
+    to_arrow_table), told apart by a Model column. Nothing is returned then.
+    """
+    with profiler.stage('csv_read'):
+        df = pd.read_csv(filename, sep=',', encoding='utf-8')
+
+    parquet = output_format == 'parquet'
+    out_filename = get_output_filename(filename, chosen_models, output_format)
+    writer = None
+    for chosen_model in chosen_models:
+        if server is None:
+            model = DeferredModel(chosen_model, backend=backend, onnx_dir=onnx_dir)
+            tokenizer = load_tokenizer(chosen_model)
+        else:
+            model, tokenizer = None, None
+        scores = get_surprisal_df(df, model, tokenizer, chosen_model, server=server, as_lists=parquet, **kwargs)
+        if parquet:
+            import pyarrow.parquet as pq
+            model_df = df.copy()
+            model_df[scores.columns] = scores
+            model_df.insert(0, 'Model', chosen_model)
+            table = to_arrow_table(model_df, float32)
+            print(f'\nWriting {chosen_model} to file: {out_filename}')
+            with profiler.stage('write'):
+                if writer is None:
+                    writer = pq.ParquetWriter(out_filename, table.schema)
+                writer.write_table(table)
+            del model_df, table
+        else:
+            df = df.join(scores.add_suffix('_' + chosen_model.replace('-', '_')))
+
+        # Free the weights before loading the next model
+        del model, tokenizer, scores
+        gc.collect()
+
+    if parquet:
+        writer.close()
+        return None
+
+    print(f'\nWriting to file: {out_filename}')
+    with profiler.stage('write'):
+        df.to_csv(out_filename,
+                  sep = ',', encoding = 'utf-8', index = False)
+    return df
+
+
+if __name__=='__main__':
 
     possible_models = ['gpt2-large', 'gpt-neo', 'llama']
-    if not chosen_model in possible_models:
-        print(f'Please enter one of the following models: {possible_models[0]}, {possible_models[1]} or {possible_models[2]}.')
-        sys.exit(1)
 
-    print('Loading model: ' + chosen_model + '...')
+    parser = argparse.ArgumentParser(
+        usage=f"{sys.argv[0]} <model[,model...]> <stimuli file> [--batch-size N] [--share-prefix]"
+              " [--sliding-window [--window N] [--stride N]]"
+              " [--target-pos N | --target-column COLUMN] [--target-only]"
+              " [--entropy] [--top-k N [--first-tokens]]"
+              " [--workers N [--threads-per-worker N]]"
+              " [--backend torch|torch-int8|onnx [--fidelity-report]]"
+              " [--stream [--chunk-rows N] [--resume]] [--no-cache | --refresh] [--server URL]"
+              " [--profile] [--trace FILE] [--format csv|parquet [--float32]]",
+        epilog=f"EXAMPLE: {sys.argv[0]} gpt2-large,gpt-neo,llama stimuli.csv --batch-size 16")
+    parser.add_argument('model',
+                        help=f'model to compute surprisal with ({", ".join(possible_models)}), '
+                             'or a comma-separated list of models to score one after the other into one output file')
+    parser.add_argument('filename', help='csv file with a FullSentence column')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='number of sentences per padded forward pass (default: 1, one sentence at a time)')
+    parser.add_argument('--share-prefix', action='store_true',
+                        help='run shared sentence prefixes (e.g. the context of all conditions of an item) only once and '
+                             'reuse their key/value cache (ignores --batch-size)')
+    parser.add_argument('--cache', default='surprisal_cache.sqlite',
+                        help='SQLite file caching the surprisals of scored sentences (default: surprisal_cache.sqlite)')
+    parser.add_argument('--cache-size', type=float, default=500,
+                        help='maximum cache size in MB; least recently used entries are evicted beyond it (default: 500)')
+    parser.add_argument('--sliding-window', action='store_true',
+                        help='score each text as a whole with a sliding window instead of independent word chunks')
+    parser.add_argument('--window', type=int, default=None,
+                        help='tokens per sliding window (default: the maximum context of the model)')
+    parser.add_argument('--stride', type=int, default=None,
+                        help='new tokens scored per window step (default: half the window)')
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--target-pos', type=int, default=6,
+                        help='word position (1-based) of the target word in every sentence (default: 6)')
+    target.add_argument('--target-column', default=None,
+                        help='column giving the target of each row, as 1-based word position (e.g. TargetPos) '
+                             'or as the target word (e.g. TargetWord)')
+    parser.add_argument('--target-only', action='store_true',
+                        help='only score each sentence up to its target word and only output TargetSurprisal')
+    parser.add_argument('--entropy', action='store_true',
+                        help='add the entropy of the next-word distribution before every word (Entropies) '
+                             'and before the target word (TargetEntropy)')
+    parser.add_argument('--top-k', type=int, default=0,
+                        help='add the N most probable words at the target position (TopKWords, TopKProbs)')
+    parser.add_argument('--first-tokens', action='store_true',
+                        help='report the top-k predicted first tokens instead of completing them into whole words')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes sharing the model weights (default: 1)')
+    parser.add_argument('--threads-per-worker', type=int, default=None,
+                        help='torch threads per worker process (default: number of cores / workers)')
+    parser.add_argument('--backend', choices=BACKENDS, default='torch',
+                        help='inference backend: fp32 torch, dynamically int8-quantized torch, '
+                             'or ONNX Runtime (default: torch)')
+    parser.add_argument('--onnx-dir', default='onnx_models',
+                        help='directory for exported ONNX graphs (default: onnx_models)')
+    parser.add_argument('--fidelity-report', action='store_true',
+                        help='also score all sentences with the fp32 model and report the maximum and mean absolute '
+                             'surprisal difference of the chosen backend')
+    parser.add_argument('--stream', action='store_true',
+                        help='read, score and write the file in chunks of rows, with a checkpoint after each chunk')
+    parser.add_argument('--chunk-rows', type=int, default=1000,
+                        help='rows per chunk in streaming mode (default: 1000)')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue an interrupted streaming run after its last checkpoint (implies --stream)')
+    parser.add_argument('--logit-chunk-size', type=int, default=LOGIT_CHUNK_SIZE,
+                        help=f'number of positions sent through the LM head at once (default: {LOGIT_CHUNK_SIZE})')
+    parser.add_argument('--server', default=None,
+                        help='score on a running surprisal_server.py at this address (e.g. http://127.0.0.1:8765) '
+                             'instead of loading the model; the cache is not used')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv',
+                        help='output format; parquet stores the per-word values as typed list columns and stacks '
+                             'several models as row groups with a Model column (needs pyarrow; default: csv)')
+    parser.add_argument('--float32', action='store_true',
+                        help='store the surprisals and probabilities of parquet output in single precision')
+    parser.add_argument('--profile', action='store_true',
+                        help='print the time spent in every stage (CSV read, tokenization, forward pass, '
+                             'softmax/gather, aggregation, write), token counts and peak memory at the end')
+    parser.add_argument('--trace', default=None,
+                        help='also write every stage call and scored sentence to this JSON-lines file '
+                             '(implies --profile)')
+    cache_mode = parser.add_mutually_exclusive_group()
+    cache_mode.add_argument('--no-cache', action='store_true',
+                            help='neither read from nor write to the cache')
+    cache_mode.add_argument('--refresh', action='store_true',
+                            help='rescore all sentences and overwrite their cached values')
+    args = parser.parse_args()
 
-    if "neo" in chosen_model:
-        model_name = 'EleutherAI/gpt-neo-2.7B'
-        tokenizer = AutoTokenizer.from_pretrained(model_name, add_prefix_space=True)
-        model = AutoModelForCausalLM.from_pretrained(model_name)
-    elif "llama" in chosen_model:
-        try:
-            with open("access_token.txt", "r") as file:
-                access_token = file.read().strip()
-        except:
-            print("Could not read Llama access token. Check that 'access_token.txt' is present in the working directory.")
-            sys.exit(1)
-        login(token = access_token)
-        model_name = "meta-llama/Meta-Llama-3-8B"
-        tokenizer = AutoTokenizer.from_pretrained(model_name, padding_side='left')
-        model = AutoModelForCausalLM.from_pretrained(model_name) #, device_map="auto")
+    chosen_models = [m.strip().lower() for m in args.model.split(',')]
+    for chosen_model in chosen_models:
+        if not chosen_model in possible_models:
+            parser.error(f'Please enter one or more of the following models: {", ".join(possible_models)}.')
+    if (args.stream or args.resume) and len(chosen_models) > 1:
+        parser.error('Streaming (--stream, --resume) scores one model at a time.')
+    if args.format == 'parquet':
+        if args.stream or args.resume:
+            parser.error('Streaming (--stream, --resume) only writes csv.')
+        if importlib.util.find_spec('pyarrow') is None:
+            parser.error('--format parquet needs the pyarrow package (pip install pyarrow).')
+    if args.server and (args.entropy or args.top_k):
+        parser.error('--entropy and --top-k need the local model and cannot be used with --server.')
+    # the onnx backend has no key/value cache; fail before loading (and exporting) the model
+    if args.backend == 'onnx' and not args.server:
+        if args.share_prefix:
+            parser.error('--share-prefix needs a key/value cache, which the onnx backend does not support. '
+                         'Use the torch or torch-int8 backend instead.')
+        if args.sliding_window and 'llama' in chosen_models:
+            parser.error('--sliding-window on llama needs a key/value cache, which the onnx backend does not '
+                         'support. Use the torch or torch-int8 backend instead.')
+    filename = args.filename
+    LOGIT_CHUNK_SIZE = args.logit_chunk_size
+
+    if args.profile or args.trace:
+        profiler.enable(trace_path=args.trace)
+
+    # the server keeps the models loaded, the cache needs the local model to build its keys
+    cache = None if args.no_cache or args.server else SurprisalCache(args.cache, max_size_mb=args.cache_size)
+
+    options = dict(cache=cache, refresh=args.refresh,
+                   target_pos=args.target_pos, target_column=args.target_column,
+                   target_only=args.target_only,
+                   entropy=args.entropy, top_k=args.top_k, complete=not args.first_tokens,
+                   workers=args.workers, threads_per_worker=args.threads_per_worker,
+                   fidelity_report=args.fidelity_report,
+                   batch_size=args.batch_size, share_prefix=args.share_prefix,
+                   sliding_window=args.sliding_window, window=args.window, stride=args.stride,
+                   server=args.server)
+    output_options = dict(output_format=args.format, float32=args.float32)
+
+    if len(chosen_models) == 1:
+        chosen_model = chosen_models[0]
+        if args.server:
+            model, tokenizer = None, None
+        else:
+            model = DeferredModel(chosen_model, backend=args.backend, onnx_dir=args.onnx_dir)
+            tokenizer = load_tokenizer(chosen_model)
+        if args.stream or args.resume:
+            get_surprisal_file_stream(model, tokenizer, chosen_model, filename,
+                                      chunk_rows=args.chunk_rows, resume=args.resume, **options)
+        else:
+            get_surprisal_file(model, tokenizer, chosen_model, filename, **output_options, **options)
     else:
-        model_name = 'openai-community/gpt2-large'
-        tokenizer = AutoTokenizer.from_pretrained(model_name, add_prefix_space=True)
-        model = AutoModelForCausalLM.from_pretrained(model_name)
+        get_surprisal_file_models(chosen_models, filename,
+                                  backend=args.backend, onnx_dir=args.onnx_dir, **output_options, **options)
 
-    # Creating model and tokenizer instances
-    #tokenizer = AutoTokenizer.from_pretrained(model_name, add_prefix_space=True)
-    #model = AutoModelForCausalLM.from_pretrained(model_name)
-    model.eval()
+    if cache is not None:
+        cache.close()
 
-    get_surprisal_file(model, chosen_model, filename)
+    if profiler.enabled:
+        print('\n' + profiler.summary(peak_rss_mb=get_peak_rss_mb()))
+        profiler.disable()
 
     print('Done')
@@ -0,0 +1,194 @@
+'''
+Inference backends for surprisal.py
+
+ABOUT:
+Converts a loaded Hugging Face causal LM to a faster CPU inference backend:
+
+- torch:      the model as loaded (fp32), no conversion.
+- torch-int8: dynamic int8 quantization of all linear layers (weights are
+              stored as int8, activations are quantized on the fly).
+- onnx:       the transformer body is exported to an ONNX graph and run with
+              ONNX Runtime. The LM head stays in torch, so that surprisal.py
+              can still apply it in chunks instead of materializing the full
+              logits.
+
+The onnx backend needs the onnx and onnxruntime packages. It runs every
+forward pass from scratch, so it cannot be combined with key/value caching
+(--share-prefix, or the sliding window on rotary-position models like
+Llama).
+
+torch is only imported once a model is converted, so that importing this
+module (e.g. for BACKENDS) stays cheap.
+'''
+
+
+import os
+from types import SimpleNamespace
+
+
+BACKENDS = ['torch', 'torch-int8', 'onnx']
+
+
+def get_backend(model):
+    """
+    Name of the backend a (converted) model runs on.
+    """
+    return getattr(model, 'backend', 'torch')
+
+
+def conv1d_to_linear(model):
+    """
+    Replace the Conv1D layers of GPT-2 style models (a linear layer with
+    transposed weights) by torch.nn.Linear, so that dynamic quantization
+    picks them up.
+    """
+    import torch
+
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if type(child).__name__ != 'Conv1D':
+                continue
+            n_in, n_out = child.weight.shape
+            linear = torch.nn.Linear(n_in, n_out, bias=child.bias is not None)
+            linear.weight.data = child.weight.data.t().contiguous()
+            if child.bias is not None:
+                linear.bias.data = child.bias.data
+            setattr(module, child_name, linear)
+    return model
+
+
+def quantize_int8(model):
+    """
+    Dynamically quantize all linear layers of the model to int8 (in place).
+    """
+    import torch
+    from torch.ao.quantization import quantize_dynamic
+
+    model = conv1d_to_linear(model)
+    model = quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8,
+                             inplace=True)
+    model.backend = 'torch-int8'
+    return model
+
+
+class OnnxBaseModel:
+    """
+    Callable standing in for model.base_model that runs the exported
+    transformer body in an ONNX Runtime session.
+    """
+
+    def __init__(self, session):
+        self.session = session
+
+    def __call__(self, input_ids, attention_mask=None, position_ids=None,
+                 past_key_values=None, use_cache=False, **kwargs):
+        import torch
+
+        if past_key_values is not None or use_cache:
+            raise ValueError(
+                "The onnx backend does not support key/value caching "
+                "(--share-prefix, or the sliding window on rotary-position "
+                "models). Use the torch or torch-int8 backend instead."
+            )
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        if position_ids is None:
+            position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        hidden = self.session.run(None, {
+            'input_ids': input_ids.numpy(),
+            'attention_mask': attention_mask.numpy(),
+            'position_ids': position_ids.numpy(),
+        })[0]
+        return SimpleNamespace(last_hidden_state=torch.from_numpy(hidden),
+                               past_key_values=None)
+
+
+class OnnxCausalLM:
+    """
+    Causal LM whose transformer body runs in ONNX Runtime, offering the parts
+    of the Hugging Face model interface used by surprisal.py (config,
+    base_model and get_output_embeddings). Only the LM head of the torch
+    model is kept.
+    """
+
+    backend = 'onnx'
+
+    def __init__(self, model, onnx_path):
+        import onnxruntime
+
+        if not os.path.isfile(onnx_path):
+            export_onnx(model, onnx_path)
+        self.session = onnxruntime.InferenceSession(
+            onnx_path, providers=['CPUExecutionProvider'])
+        self.config = model.config
+        self.base_model = OnnxBaseModel(self.session)
+        self.lm_head = model.get_output_embeddings()
+
+    def get_output_embeddings(self):
+        return self.lm_head
+
+    def eval(self):
+        return self
+
+
+def export_onnx(model, onnx_path):
+    """
+    Export the transformer body of a causal LM to an ONNX graph with dynamic
+    batch and sequence dimensions.
+    """
+    import torch
+
+    class HiddenStates(torch.nn.Module):
+        """
+        The transformer body returning its final hidden states as a plain
+        tensor (the form needed for the export).
+        """
+
+        def __init__(self, base_model):
+            super().__init__()
+            self.base_model = base_model
+
+        def forward(self, input_ids, attention_mask, position_ids):
+            return self.base_model(input_ids=input_ids,
+                                   attention_mask=attention_mask,
+                                   position_ids=position_ids,
+                                   use_cache=False).last_hidden_state
+
+    print(f'Exporting model to ONNX: {onnx_path}...')
+    os.makedirs(os.path.dirname(os.path.abspath(onnx_path)), exist_ok=True)
+    example = torch.ones((1, 8), dtype=torch.long)
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'}
+                    for name in ['input_ids', 'attention_mask',
+                                 'position_ids', 'last_hidden_state']}
+    with torch.no_grad():
+        torch.onnx.export(HiddenStates(model.base_model).eval(),
+                          (example, example, torch.arange(8).unsqueeze(0)),
+                          onnx_path,
+                          input_names=['input_ids', 'attention_mask',
+                                       'position_ids'],
+                          output_names=['last_hidden_state'],
+                          dynamic_axes=dynamic_axes,
+                          opset_version=17,
+                          dynamo=False)
+
+
+def convert_model(model, backend, onnx_path=None):
+    """
+    Convert a loaded fp32 model to the given backend (see BACKENDS).
+
+    Parameters:
+    model: the Hugging Face causal LM.
+    backend (str): 'torch', 'torch-int8' or 'onnx'.
+    onnx_path (str): where to store (or find) the exported ONNX graph;
+                     required for the onnx backend.
+    """
+    if backend == 'torch':
+        return model
+    if backend == 'torch-int8':
+        return quantize_int8(model)
+    if backend == 'onnx':
+        if onnx_path is None:
+            raise ValueError("The onnx backend needs an onnx_path.")
+        return OnnxCausalLM(model, onnx_path)
+    raise ValueError(f"Unknown backend '{backend}', choose one of: "
+                     f"{', '.join(BACKENDS)}.")
@@ -0,0 +1,152 @@
+'''
+Persistent surprisal cache
+Used by surprisal.py
+
+ABOUT:
+Stores the word surprisals of every scored sentence in an SQLite file, so
+that re-running surprisal.py on an updated stimulus file only sends new or
+edited sentences through the model.
+Entries are content-addressed: the key is a hash of the model (name and
+revision), the tokenizer and the exact sentence. When the file grows beyond
+its maximum size, the least recently used entries are evicted.
+'''
+
+
+import hashlib
+import json
+import sqlite3
+import time
+
+
+class SurprisalCache:
+    """
+    Content-addressed on-disk store mapping (model, tokenizer, sentence) to
+    the per-word surprisals of the sentence.
+
+    Parameters:
+    path (str): location of the SQLite file (created if missing).
+    max_size_mb (float): maximum total size of the stored values in MB;
+                         least recently used entries are evicted beyond it.
+    """
+
+    def __init__(self, path, max_size_mb=500):
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS surprisal ("
+            "key TEXT PRIMARY KEY, model TEXT, sentence TEXT, "
+            "value TEXT, size INTEGER, last_used REAL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS surprisal_last_used "
+            "ON surprisal (last_used)"
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def key(model_id, sentence):
+        return hashlib.sha256(
+            json.dumps([model_id, sentence]).encode('utf-8')
+        ).hexdigest()
+
+    def get_many(self, model_id, sentences):
+        """
+        Look up several sentences at once. Returns a dict mapping every cached
+        sentence to its (words, surprisals) tuple; missing sentences are
+        left out.
+        """
+        keys = {self.key(model_id, s): s for s in set(sentences)}
+        found = {}
+        key_list = list(keys)
+        # stay below SQLite's limit on the number of query parameters
+        for start in range(0, len(key_list), 500):
+            chunk = key_list[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT key, value FROM surprisal WHERE key IN ({placeholders})",
+                chunk
+            ).fetchall()
+            for key, value in rows:
+                value = json.loads(value)
+                found[keys[key]] = (value['words'], value['surprisals'])
+
+        if found:
+            now = time.time()
+            self.connection.executemany(
+                "UPDATE surprisal SET last_used = ? WHERE key = ?",
+                [(now, self.key(model_id, s)) for s in found]
+            )
+            self.connection.commit()
+        return found
+
+    def put_many(self, model_id, results):
+        """
+        Store several results at once. results maps each sentence to its
+        (words, surprisals) tuple. Existing entries are overwritten.
+        """
+        now = time.time()
+        rows = []
+        for sentence, (words, surprisals) in results.items():
+            value = json.dumps({'words': list(words),
+                                'surprisals': [float(s) for s in surprisals]})
+            rows.append((self.key(model_id, sentence), model_id, sentence,
+                         value, len(value), now))
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO surprisal "
+            "(key, model, sentence, value, size, last_used) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        self.connection.commit()
+        self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the stored values fit
+        into the maximum cache size again.
+        """
+        total = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM surprisal"
+        ).fetchone()[0]
+        if total <= self.max_size:
+            return 0
+
+        evicted = []
+        cursor = self.connection.execute(
+            "SELECT key, size FROM surprisal ORDER BY last_used ASC"
+        )
+        for key, size in cursor:
+            if total <= self.max_size:
+                break
+            evicted.append((key,))
+            total -= size
+        self.connection.executemany("DELETE FROM surprisal WHERE key = ?",
+                                    evicted)
+        self.connection.commit()
+        return len(evicted)
+
+    def close(self):
+        self.connection.close()
+
+
+def model_cache_id(model, tokenizer, **scoring):
+    """
+    Identify a model/tokenizer pair for the cache key: model name and
+    revision (the commit hash of the downloaded checkpoint, if known) plus
+    the tokenizer's name, class and word-prefix setting. Scoring settings
+    that change the resulting values (e.g. the sliding window) can be added
+    as keyword arguments.
+    """
+    config = model.config
+    revision = getattr(config, '_commit_hash', None) or 'unknown'
+    model_id = {
+        'model': getattr(config, '_name_or_path', type(model).__name__),
+        'revision': revision,
+        'tokenizer': getattr(tokenizer, 'name_or_path', ''),
+        'tokenizer_class': type(tokenizer).__name__,
+        'add_prefix_space': getattr(tokenizer, 'add_prefix_space', None),
+    }
+    if scoring:
+        model_id['scoring'] = scoring
+    return json.dumps(model_id, sort_keys=True)
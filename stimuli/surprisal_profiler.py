@@ -0,0 +1,145 @@
+'''
+Stage timing for surprisal.py
+
+ABOUT:
+Records the wall time and number of calls of every stage of a scoring run
+(CSV read, tokenization, forward pass, LM head softmax/gather, word
+aggregation, write), counters such as the number of sentences and tokens,
+and the peak memory use. At the end of a run, summary() gives a table of
+the stages; with a trace file, every stage call and every scored sentence is
+also written as one JSON line.
+
+The profiler is off by default. Stages are then an empty context manager
+and counters return right away, so the instrumentation costs next to
+nothing.
+
+With worker processes (--workers), only the stages of the main process are
+recorded.
+'''
+
+
+import contextlib
+import json
+import time
+
+
+class Profiler:
+    """
+    Collects stage timings and counters.
+
+    Usage:
+    profiler.enable(trace_path=None)
+    with profiler.stage('forward'):
+        ...
+    profiler.count('tokens', n)
+    print(profiler.summary())
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.trace = None
+        self.reset()
+
+    def reset(self):
+        self.start = time.perf_counter()
+        self.seconds = {}
+        self.calls = {}
+        self.counters = {}
+        self.values = {}
+
+    def enable(self, trace_path=None):
+        """
+        Start recording (from scratch). With trace_path, every event is also
+        written to that file as one JSON line.
+        """
+        self.enabled = True
+        self.reset()
+        if trace_path is not None:
+            self.trace = open(trace_path, 'w', encoding='utf-8')
+
+    def disable(self):
+        self.enabled = False
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+    def stage(self, name):
+        """
+        Context manager timing one call of a stage.
+        """
+        if not self.enabled:
+            return _NO_STAGE
+        return self._timed(name)
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if self.trace is not None:
+                self.write({'event': 'stage', 'stage': name, 'start': start - self.start, 'seconds': seconds})
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value, **fields):
+        """
+        Record one value of a distribution (e.g. the number of tokens of a
+        sentence); the summary shows its minimum, mean and maximum.
+        """
+        if not self.enabled:
+            return
+        self.values.setdefault(name, []).append(value)
+        if self.trace is not None:
+            self.write({'event': name, 'value': value, **fields})
+
+    def write(self, event):
+        self.trace.write(json.dumps(event) + '\n')
+
+    def report(self, peak_rss_mb=None):
+        """
+        The recorded totals as a dict (also written to the trace).
+        """
+        report = {'wall_seconds': time.perf_counter() - self.start,
+                  'stages': {name: {'calls': self.calls[name], 'seconds': self.seconds[name]}
+                             for name in self.seconds},
+                  'counters': dict(self.counters),
+                  'distributions': {name: {'n': len(values), 'min': min(values),
+                                           'mean': sum(values) / len(values), 'max': max(values)}
+                                    for name, values in self.values.items()},
+                  'peak_rss_mb': peak_rss_mb}
+        if self.trace is not None:
+            self.write({'event': 'summary', **report})
+        return report
+
+    def summary(self, peak_rss_mb=None):
+        """
+        The recorded totals as a printable table.
+        """
+        report = self.report(peak_rss_mb)
+        wall = report['wall_seconds']
+        lines = [f"{'Stage':<14}{'Calls':>8}{'Total s':>10}{'Mean ms':>10}{'Share':>8}"]
+        for name, stage in report['stages'].items():
+            lines.append(f"{name:<14}{stage['calls']:>8}{stage['seconds']:>10.3f}"
+                         f"{1000 * stage['seconds'] / stage['calls']:>10.3f}"
+                         f"{100 * stage['seconds'] / wall if wall else 0:>7.1f}%")
+        lines.append(f"{'total (wall)':<14}{'':>8}{wall:>10.3f}")
+        for name, value in report['counters'].items():
+            lines.append(f"{name}: {value}")
+        for name, values in report['distributions'].items():
+            lines.append(f"{name}: min {values['min']}, mean {values['mean']:.1f}, max {values['max']}")
+        if peak_rss_mb is not None:
+            lines.append(f"peak RSS: {peak_rss_mb:.0f} MB")
+        return "\n".join(lines)
+
+
+_NO_STAGE = contextlib.nullcontext()
+
+# The profiler used by surprisal.py
+profiler = Profiler()
@@ -0,0 +1,206 @@
+'''
+Surprisal scoring server
+
+ABOUT:
+This script keeps one or more models loaded in memory and scores sentences
+sent to it over a local HTTP connection, so that repeated scoring of small
+sets of new items does not pay for importing torch/transformers and loading
+the weights every time.
+
+Sentences from concurrent requests for the same model are collected for a
+few milliseconds and scored together in shared batches.
+
+API:
+GET  /models   -> {"models": ["gpt2-large", ...]}
+POST /score    <- {"model": "gpt2-large", "sentences": ["...", ...]}
+               -> {"results": [{"words": [...], "surprisals": [...],
+                                "probs": [...]}, ...]}
+
+The scoring client is surprisal.py with the --server option.
+
+USAGE:
+python surprisal_server.py <model[,model...]> [--port N] [--batch-size N]
+
+EXAMPLE:
+python surprisal_server.py gpt2-large,llama --port 8765
+python surprisal.py gpt2-large stimuli.csv --server http://127.0.0.1:8765
+'''
+
+
+import argparse
+import json
+import queue
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from surprisal import load_model, get_word_surprisal_many
+from surprisal_backends import BACKENDS
+
+
+class ScoringQueue:
+    """
+    Scores the sentences of all requests for one model on a single worker
+    thread. Requests arriving within max_wait seconds of each other (up to
+    max_sentences sentences) are coalesced into one call of
+    get_word_surprisal_many, with duplicate sentences scored once.
+    """
+
+    def __init__(self, model, tokenizer, llama, max_wait=0.01,
+                 max_sentences=256, **options):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.llama = llama
+        self.max_wait = max_wait
+        self.max_sentences = max_sentences
+        self.options = options
+        self.requests = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def score(self, sentences):
+        """
+        Queue the sentences of one request and wait for their
+        (words, surprisals) tuples.
+        """
+        job = {'sentences': sentences, 'done': threading.Event()}
+        self.requests.put(job)
+        job['done'].wait()
+        if 'error' in job:
+            raise RuntimeError(job['error'])
+        return job['results']
+
+    def run(self):
+        while True:
+            jobs = [self.requests.get()]
+            n_sentences = len(jobs[0]['sentences'])
+            deadline = time.monotonic() + self.max_wait
+            while n_sentences < self.max_sentences:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    jobs.append(self.requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+                n_sentences += len(jobs[-1]['sentences'])
+
+            sentences = list(dict.fromkeys(s for job in jobs
+                                           for s in job['sentences']))
+            try:
+                results = dict(zip(sentences, get_word_surprisal_many(
+                    sentences, self.model, self.tokenizer, llama=self.llama,
+                    **self.options)))
+                for job in jobs:
+                    job['results'] = [results[s] for s in job['sentences']]
+            except Exception as e:
+                for job in jobs:
+                    job['error'] = f'{type(e).__name__}: {e}'
+            for job in jobs:
+                job['done'].set()
+
+
+def make_handler(queues):
+
+    class SurprisalHandler(BaseHTTPRequestHandler):
+
+        def send_json(self, status, content):
+            body = json.dumps(content).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/models':
+                self.send_json(200, {'models': list(queues)})
+            else:
+                self.send_json(404, {'error': f'Unknown path: {self.path}'})
+
+        def do_POST(self):
+            if self.path != '/score':
+                self.send_json(404, {'error': f'Unknown path: {self.path}'})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length))
+                chosen_model = request['model']
+                sentences = request['sentences']
+            except (ValueError, KeyError, TypeError):
+                self.send_json(400, {'error': 'Expected a JSON object with '
+                                              '"model" and "sentences".'})
+                return
+            if chosen_model not in queues:
+                self.send_json(400, {'error': f'Model {chosen_model} is not '
+                                              f'loaded; available: '
+                                              f'{", ".join(queues)}.'})
+                return
+            try:
+                results = queues[chosen_model].score(sentences)
+            except RuntimeError as e:
+                self.send_json(500, {'error': str(e)})
+                return
+            self.send_json(200, {'results': [
+                {'words': words,
+                 'surprisals': surprisals,
+                 'probs': [1/(2**s) for s in surprisals]}
+                for words, surprisals in results
+            ]})
+
+        def log_message(self, format, *args):
+            pass
+
+    return SurprisalHandler
+
+
+if __name__ == '__main__':
+
+    possible_models = ['gpt2-large', 'gpt-neo', 'llama']
+
+    parser = argparse.ArgumentParser(
+        usage=f"{sys.argv[0]} <model[,model...]> [--host HOST] [--port N]"
+              " [--batch-size N] [--share-prefix] [--backend BACKEND]",
+        epilog=f"EXAMPLE: {sys.argv[0]} gpt2-large,llama --port 8765")
+    parser.add_argument('model',
+                        help='model(s) to keep loaded, comma-separated '
+                             f'({", ".join(possible_models)})')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8765,
+                        help='port to listen on (default: 8765)')
+    parser.add_argument('--batch-size', type=int, default=16,
+                        help='sentences per padded forward pass (default: 16)')
+    parser.add_argument('--share-prefix', action='store_true',
+                        help='reuse the key/value cache of shared sentence '
+                             'prefixes (ignores --batch-size)')
+    parser.add_argument('--max-wait', type=float, default=0.01,
+                        help='seconds to wait for more requests to coalesce '
+                             'into one batch (default: 0.01)')
+    parser.add_argument('--backend', choices=BACKENDS, default='torch',
+                        help='inference backend (default: torch)')
+    args = parser.parse_args()
+
+    chosen_models = [m.strip().lower() for m in args.model.split(',')]
+    for chosen_model in chosen_models:
+        if not chosen_model in possible_models:
+            parser.error('Please enter one or more of the following models: '
+                         f'{", ".join(possible_models)}.')
+
+    queues = {}
+    for chosen_model in chosen_models:
+        model, tokenizer = load_model(chosen_model, backend=args.backend)
+        queues[chosen_model] = ScoringQueue(model, tokenizer,
+                                            llama='llama' in chosen_model,
+                                            max_wait=args.max_wait,
+                                            batch_size=args.batch_size,
+                                            share_prefix=args.share_prefix)
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(queues))
+    print(f'Serving {", ".join(chosen_models)} on '
+          f'http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('\nShutting down.')
+        server.server_close()
@@ -0,0 +1,326 @@
+'''
+Pseudorandomization validation
+
+ABOUT:
+This script checks the files written by pseudorandomize_many_orders.py
+or pseudorandomize.py: every order (Group) is checked again against the
+rules of the generator, by default "pseudorandomization_constraints.txt"
+(see parse_rules in pseudorandomize.py). For pseudorandomize.py, pass its
+rules file with --constraints pseudorandomization_constraints_single.txt.
+
+It reports:
+- runs longer than allowed by a Constraint rule (empty cells are skipped);
+- rows closer together than allowed by a Distance rule;
+- rows at the positions of a Position rule that do not match it (and, for
+  fixed rules, orders that do not start with the same row as the first);
+- ItemNum values that occur more than once in an order;
+- orders that are identical to an earlier order of the same file;
+- if the original list is found next to the file (the same name without
+  "_pseudorandomized"), orders whose items differ from it.
+
+Compact files ("_orders", see pseudorandomize_many_orders.py --compact)
+are expanded with the original list first.
+
+All checks work on whole columns at once (run lengths are computed for all
+orders together), so thousands of orders take well under a second. The
+script exits with status 1 if any problem was found, so that it can be
+run as the last step of a generation run.
+
+USAGE:
+python validate_pseudorandomization.py <files or folders>
+                                       [--constraints FILE]
+
+EXAMPLES:
+python validate_pseudorandomization.py pcibex_lists
+python validate_pseudorandomization.py comprehension_l1_pseudorandomized.csv --constraints pseudorandomization_constraints_single.txt
+'''
+
+
+import sys
+import os
+import argparse
+import time
+import pandas as pd
+import numpy as np
+
+from pseudorandomize import read_rules, match_conditions
+from pseudorandomize_many_orders import load_list, expand_orders
+
+
+def get_positions(df):
+    """
+    Function that numbers the rows of each order (Group), from 1.
+    A file without a Group column is a single order.
+
+    Returns:
+    groups (array): the order of each row.
+    positions (array): the position of each row in its order.
+    """
+    if "Group" in df.columns:
+        groups = df["Group"].to_numpy()
+    else:
+        groups = np.ones(len(df), dtype=np.int64)
+    positions = pd.Series(groups).groupby(groups).cumcount().to_numpy() + 1
+    return groups, positions
+
+
+def check_runs(df, groups, positions, column, limits):
+    """
+    Function that finds the runs of equal values in column that are longer
+    than allowed, with run-length encoding over all orders at once.
+    Empty cells are skipped (they neither end nor extend a run).
+
+    Parameters:
+    df (dataframe): the orders, one after the other.
+    groups, positions (array): see get_positions.
+    column (str): the constrained column.
+    limits (array): maximal run length at each position (index 0 unused).
+
+    Returns:
+    violations (list): (group, position, message) per run that is too long,
+                       at the first position where it is.
+    """
+    filled = df[column].notna().to_numpy()
+    values = pd.factorize(df[column])[0][filled]
+    groups, positions = groups[filled], positions[filled]
+    if not len(values):
+        return []
+
+    # A run starts at a new order or a new value
+    starts = np.ones(len(values), dtype=bool)
+    starts[1:] = (values[1:] != values[:-1]) | (groups[1:] != groups[:-1])
+    run_ids = np.cumsum(starts) - 1
+    run_starts = np.flatnonzero(starts)
+    lengths = np.arange(len(values)) - run_starts[run_ids] + 1
+
+    too_long = np.flatnonzero(lengths > limits[positions])
+    # Report each run once
+    too_long = too_long[np.unique(run_ids[too_long], return_index=True)[1]]
+    cells = df[column].to_numpy()[filled]
+    return [(groups[i], positions[i],
+             f"{lengths[i]} rows in a row with {column} = {cells[i]} "
+             f"(at most {limits[positions[i]]})")
+            for i in too_long]
+
+
+def check_distances(df, groups, positions, column, min_distance):
+    """
+    Function that finds rows that are closer to the previous row with the
+    same value in column than min_distance positions (empty cells skipped).
+
+    Returns:
+    violations (list): (group, position, message) per row.
+    """
+    filled = df[column].notna().to_numpy()
+    values = pd.factorize(df[column])[0][filled]
+    groups, positions = groups[filled], positions[filled]
+    if not len(values):
+        return []
+
+    # Rows with the same value of the same order next to each other, in
+    # the order of their positions
+    ordered = np.lexsort((positions, values, pd.factorize(groups)[0]))
+    same = ((values[ordered][1:] == values[ordered][:-1])
+            & (groups[ordered][1:] == groups[ordered][:-1]))
+    distances = np.diff(positions[ordered])
+    close = np.flatnonzero(same & (distances < min_distance)) + 1
+    cells = df[column].to_numpy()[filled][ordered]
+    return [(groups[ordered][i], positions[ordered][i],
+             f"{column} = {cells[i]} again "
+             f"after {distances[i - 1]} positions "
+             f"(at least {min_distance})")
+            for i in close]
+
+
+def validate_orders(df, rules, df_original=None):
+    """
+    Function that checks all orders of one file.
+
+    Parameters:
+    df (dataframe): the orders, one after the other, with the order number
+                    in the Group column.
+    rules (list): see read_rules.
+    df_original (dataframe): the list the orders were drawn from, if
+                             available.
+
+    Returns:
+    violations (dataframe): one row per problem, with the columns Group,
+                            Position (None if it concerns the whole order),
+                            Check and Message.
+    """
+    groups, positions = get_positions(df)
+    n = int(positions.max()) if len(positions) else 0
+    no_limit = n + 1
+    violations = []
+
+    def add(check, found):
+        violations.extend((group, position, check, message)
+                          for group, position, message in found)
+
+    # Constraint rules: the general limit, replaced at given positions
+    run_rules = [rule for rule in rules if rule["rule"] == "Constraint"]
+    for column in dict.fromkeys(rule["column"] for rule in run_rules):
+        limits = np.full(n + 1, no_limit)
+        for rule in sorted((rule for rule in run_rules
+                            if rule["column"] == column),
+                           key=lambda rule: rule["positions"] is not None):
+            if rule["positions"] is None:
+                limits[:] = rule["max_run"]
+            else:
+                limits[[p for p in rule["positions"] if p <= n]] = \
+                    rule["max_run"]
+        add(f"Constraint {column}",
+            check_runs(df, groups, positions, column, limits))
+
+    for rule in rules:
+        if rule["rule"] == "Distance":
+            add(f"Distance {rule['column']}",
+                check_distances(df, groups, positions, rule["column"],
+                                rule["min_distance"]))
+        elif rule["rule"] == "Position":
+            description = " ".join(f"{column}{operator}{value}"
+                                   for column, operator, value
+                                   in rule["conditions"])
+            at_rule = np.isin(positions, rule["positions"])
+            wrong = np.flatnonzero(at_rule
+                                   & ~match_conditions(df, rule["conditions"]))
+            add(f"Position {description}",
+                [(groups[i], positions[i], "row does not match")
+                 for i in wrong])
+            if rule["fixed"] and "ItemNum" in df.columns:
+                items = df["ItemNum"].to_numpy()[at_rule]
+                add(f"Position {description}",
+                    [(group, rule["positions"][0],
+                      f"ItemNum {item} instead of {items[0]}")
+                     for group, item in zip(groups[at_rule], items)
+                     if item != items[0]])
+
+    if "ItemNum" in df.columns:
+        duplicated = np.flatnonzero(
+            pd.DataFrame({"Group": groups, "ItemNum": df["ItemNum"]})
+            .duplicated().to_numpy())
+        add("ItemNum",
+            [(groups[i], positions[i],
+              f"ItemNum {df['ItemNum'].iat[i]} occurs more than once")
+             for i in duplicated])
+
+        # Identical orders: one row of ItemNum codes per order
+        order_groups, starts, lengths = np.unique(groups, return_index=True,
+                                                  return_counts=True)
+        codes = pd.factorize(df["ItemNum"])[0]
+        if len(set(lengths)) == 1 and len(order_groups) > 1:
+            starts.sort()
+            matrix = codes[starts[:, None] + np.arange(lengths[0])]
+            _, first, inverse = np.unique(matrix, axis=0, return_index=True,
+                                          return_inverse=True)
+            inverse = inverse.reshape(-1)
+            group_of = groups[starts]
+            add("Duplicate order",
+                [(group_of[i], None,
+                  f"same order as Group {group_of[first[inverse[i]]]}")
+                 for i in range(len(starts)) if first[inverse[i]] != i])
+
+        if df_original is not None:
+            expected = np.sort(df_original["ItemNum"].to_numpy())
+            for group, items in pd.Series(df["ItemNum"].to_numpy()).groupby(
+                    groups):
+                items = np.sort(items.to_numpy())
+                if len(items) != len(expected) or \
+                        (items != expected).any():
+                    missing = sorted(set(expected.tolist())
+                                     - set(items.tolist()))
+                    extra = sorted(set(items.tolist())
+                                   - set(expected.tolist()))
+                    add("Items", [(group, None,
+                                   f"{len(items)} rows ({len(expected)} in "
+                                   f"the list), missing: {missing}, "
+                                   f"not in the list: {extra}")])
+
+    return pd.DataFrame(violations,
+                        columns=["Group", "Position", "Check", "Message"])
+
+
+def find_files(paths):
+    """
+    Function that lists the pseudorandomized files (and compact orders) in
+    the given files and folders.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += [os.path.join(path, f) for f in sorted(os.listdir(path))
+                      if f.endswith(("_pseudorandomized.csv", "_orders.csv"))]
+        else:
+            files.append(path)
+    return files
+
+
+def get_original(filepath):
+    """
+    Function that returns the path of the list a file was drawn from, or
+    None if it does not exist.
+    """
+    for suffix in ("_pseudorandomized.csv", "_orders.csv"):
+        if filepath.endswith(suffix):
+            original = filepath[:-len(suffix)] + ".csv"
+            if os.path.isfile(original):
+                return original
+    return None
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        usage=f"{sys.argv[0]} <files or folders> [--constraints FILE]",
+        epilog=f"EXAMPLE: {sys.argv[0]} pcibex_lists")
+    parser.add_argument("paths", nargs="+",
+                        help="pseudorandomized files, or folders with them")
+    parser.add_argument("--constraints",
+                        default="pseudorandomization_constraints.txt",
+                        help="rules file of the generator (default: "
+                             "pseudorandomization_constraints.txt; "
+                             "pseudorandomization_constraints_single.txt "
+                             "for pseudorandomize.py)")
+    args = parser.parse_args()
+
+    rules = read_rules(args.constraints)
+
+    files = find_files(args.paths)
+    if not files:
+        sys.exit("\n\033[31mNo pseudorandomized files found.\033[0m\n")
+
+    start_time = time.perf_counter()
+    n_problems = 0
+    n_orders = 0
+    for filepath in files:
+        original = get_original(filepath)
+        df_original = load_list(original) if original else None
+        if filepath.endswith("_orders.csv"):
+            if df_original is None:
+                sys.exit(f"\n\033[31mThe list of {filepath} was not "
+                         "found.\033[0m\n")
+            df = expand_orders(df_original, pd.read_csv(filepath))
+        else:
+            df = pd.read_csv(filepath)
+
+        violations = validate_orders(df, rules, df_original)
+        groups = df["Group"].nunique() if "Group" in df.columns else 1
+        n_orders += groups
+        n_problems += len(violations)
+
+        if len(violations):
+            print(f"\n\033[31m{filepath}: {len(violations)} problems in "
+                  f"{groups} orders\033[0m")
+            for row in violations.itertuples(index=False):
+                position = ("" if pd.isna(row.Position)
+                            else f", position {int(row.Position)}")
+                print(f"  Group {row.Group}{position}: {row.Check}: "
+                      f"{row.Message}")
+        else:
+            print(f"{filepath}: {groups} orders OK")
+
+    print(f"\nChecked {n_orders} orders in {len(files)} files in "
+          f"{time.perf_counter() - start_time:.2f} seconds.")
+    if n_problems:
+        sys.exit(f"\n\033[31m{n_problems} problems found.\033[0m\n")
+    print("\nAll orders are valid.\n")